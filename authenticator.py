@@ -39,24 +39,39 @@
 #        * python >=3.6 and the following python modules:
 #            * Requirements defined under requirements.txt
 #            * ice-python
-#            * MySQLdb
+#            * MySQLdb, PyMySQL or sqlite3
 #            * daemon (when run as a daemon)
 #            * bcrypt
 #            * passlib
 #            * zeroc-ice
+#            * Pillow (for [texture] transcode)
 #
 
 from __future__ import print_function
+import abc
 import sys
+import os
+import glob
+import shutil
+import tempfile
 import Ice
 
 from urllib.request import urlopen
 import _thread as thread
+import threading
 from threading import Timer
+import time
+import re
+import itertools
+import io
+from array import array
+from bisect import bisect_left
 
 from optparse import OptionParser
 import configparser
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
 from logging import (debug,
                      info,
                      warning,
@@ -65,9 +80,23 @@ from logging import (debug,
                      exception,
                      getLogger)
 
-from hashlib import sha1
+from hashlib import sha1, sha256
 from passlib.hash import bcrypt_sha256
 import datetime
+import signal
+import socket
+import socketserver
+import traceback
+import inspect
+import json
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    # Optional, only needed to transcode textures
+    from PIL import Image
+except ImportError:
+    Image = None
 
 __version__ = "1.1.0"
 __branch__ = "AA Base"
@@ -91,33 +120,89 @@ def x2bool(s):
     raise ValueError()
 
 
+def parse_hosts(string):
+    """
+    Helper function to convert a comma separated host[:port] list from the config
+    """
+    hosts = []
+    for entry in string.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.partition(':')
+        hosts.append((host, int(port) if port else 3306))
+    return hosts
+
+
 #
 # --- Default configuration values
 #
 cfgfile = 'authenticator.ini'
+slice_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'slices', 'cache')
 default = {'database': (('lib', str, 'MySQLdb'),
                         ('name', str, 'alliance_auth'),
                         ('user', str, 'allianceserver'),
                         ('password', str, 'password'),
                         ('prefix', str, ''),
                         ('host', str, '127.0.0.1'),
-                        ('port', int, 3306)),
+                        ('port', int, 3306),
+                        ('breaker_threshold', int, 3),
+                        ('breaker_backoff', float, 1.0),
+                        ('breaker_backoff_max', float, 60.0),
+                        ('replicas', parse_hosts, []),
+                        ('replica_max_lag', int, 30),
+                        ('replica_check_interval', int, 10),
+                        ('explain', x2bool, True)),
 
            'user': (('id_offset', int, 1000000000),
                     ('reject_on_error', x2bool, True),
                     ('avatar_enable', x2bool, False),
-                    ('ccp_avatar_url', str, '')),
+                    ('ccp_avatar_url', str, ''),
+                    ('registered_limit', int, 1000)),
+
+           'usercache': (('enabled', x2bool, True),
+                         ('refresh', int, 300)),
+
+           'reconciler': (('enabled', x2bool, False),
+                          ('interval', int, 60)),
+
+           'texture': (('transcode', x2bool, False),
+                       ('size', int, 64),
+                       ('format', str, 'PNG'),
+                       ('quality', int, 85)),
 
            'ice': (('host', str, '127.0.0.1'),
                    ('port', int, 6502),
                    ('slice', str, 'slices/murmur-1.5.ice'),
                    ('secret', str, ''),
                    ('watchdog', int, 30),
+                   ('heartbeat', int, 30),
+                   ('reconnect_backoff', float, 0.2),
+                   ('reconnect_backoff_max', float, 5.0),
                    ('endpoint', str, '127.0.0.1')),
 
            'iceraw': None,
 
            'murmur': (('servers', lambda x: list(map(int, x.split(','))), []),),
+
+           'meta:*': (('host', str, '127.0.0.1'),
+                      ('port', int, 6502),
+                      ('secret', str, ''),
+                      ('servers', lambda x: list(map(int, x.split(','))), [])),
+
+           'workers': (('count', int, 0),
+                       ('restart_delay', float, 5.0),
+                       ('max_restarts', int, 5),
+                       ('restart_window', int, 300),
+                       ('stop_timeout', int, 30)),
+
+           'drain': (('enabled', x2bool, True),
+                     ('deadline', float, 10.0)),
+
+           'warmup': (('enabled', x2bool, True),
+                      ('timeout', float, 10.0),
+                      ('avatars', x2bool, False)),
+
            'glacier': (('enabled', x2bool, False),
                        ('user', str, 'allianceserver'),
                        ('password', str, 'password'),
@@ -125,170 +210,2806 @@ default = {'database': (('lib', str, 'MySQLdb'),
                        ('port', int, '4063')),
 
            'log': (('level', int, logging.DEBUG),
-                   ('file', str, 'allianceauth.log')),
+                   ('file', str, 'allianceauth.log'),
+                   ('async_write', x2bool, False),
+                   ('queue_size', int, 10000),
+                   ('rate_limit', int, 0),
+                   ('rate_window', int, 10)),
+
+           'admission': (('enabled', x2bool, False),
+                         ('reserve', int, 2),
+                         ('auth', int, 0),
+                         ('lookup', int, 3),
+                         ('callback', int, 2),
+                         ('list', int, 1),
+                         ('texture', int, 1)),
+
+           'pool': (('enabled', x2bool, False),
+                    ('interval', int, 10),
+                    ('threads_min', int, 5),
+                    ('threads_max', int, 20),
+                    ('db_min', int, 2),
+                    ('db_max', int, 10),
+                    ('db_wait', float, 2.0),
+                    ('target_latency', int, 100),
+                    ('idle_timeout', int, 300)),
+
+           'trace': (('enabled', x2bool, False),
+                     ('slow_threshold', int, 500),
+                     ('file', str, '')),
+
+           'admin': (('enabled', x2bool, False),
+                     ('socket', str, 'authenticator.sock'),
+                     ('profile_dir', str, '.'),
+                     ('profile_interval', float, 0.005)),
 
            'idlerhandler': (('enabled', x2bool, False),
                             ('time', int, 3600),
                             ('interval', int, 60.0),
                             ('channel', int, 1),
                             ('allowlist', list, []),
-                            ('denylist', list, []))}
+                            ('denylist', list, [])),
+
+           'health': (('enabled', x2bool, False),
+                      ('host', str, '127.0.0.1'),
+                      ('port', int, 8081),
+                      ('interval', int, 15),
+                      ('timeout', float, 5.0)),
+
+           'healthcheck': (('username', str, 'healthcheck_user'),
+                           ('password', str, ''))}
+
+
+def slice_include_args():
+    slicedir = Ice.getSliceDir()
+    if not slicedir:
+        return ["-I/usr/share/Ice/slice", "-I/usr/share/slice"]
+    return ['-I' + slicedir]
+
+
+def compile_slice(slice, cachedir=slice_cache_dir):
+    """
+    Generates the Python modules for a slice file into the slice cache.
+    The cache is keyed by the hash of the slice file and the Ice version so
+    changed slices or Ice upgrades never pick up stale code.
+    Returns the directory holding the generated modules.
+    """
+    with open(slice, 'rb') as f:
+        digest = sha256(f.read() + Ice.stringVersion().encode()).hexdigest()
+    target = os.path.join(cachedir, digest)
+    if os.path.isdir(target):
+        return target
+
+    import IcePy
+    os.makedirs(cachedir, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.build-', dir=cachedir)
+    try:
+        # slice2py names the generated module after the file, murmur-1.5.ice
+        # would become the unimportable murmur-1.5_ice
+        name = re.sub(r'\W', '_', os.path.splitext(os.path.basename(slice))[0]) + '.ice'
+        source = os.path.join(tmp, name)
+        shutil.copyfile(slice, source)
+        if IcePy.compile(['slice2py'] + slice_include_args() + ['--output-dir', tmp, source]) != 0:
+            raise RuntimeError('slice2py failed for %s' % slice)
+        os.replace(tmp, target)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        # Somebody else generated the same slice in the meantime
+        if not os.path.isdir(target):
+            raise
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return target
+
+
+def import_murmur():
+    # ICE Slice module was changed from Murmur to MumbleServer in 1.5
+    try:
+        import Murmur
+        debug("Using pre-1.5 slice.")
+    except ImportError:
+        import MumbleServer as Murmur
+        debug("Using post-1.5 slice.")
+    return Murmur
+
+
+def load_slice(slice):
+    """
+    Loads the Murmur slice and returns its module, preferring precompiled
+    modules from the slice cache and falling back to parsing the slice at
+    runtime when they can not be generated or imported
+    """
+    start = time.perf_counter()
+    target = None
+    try:
+        target = compile_slice(slice)
+        sys.path.insert(0, target)
+        module = import_murmur()
+        source = 'cache'
+    except Exception as e:
+        debug('Could not use slice cache: %s', str(e) or e.__class__.__name__)
+        if target is not None:
+            sys.path.remove(target)
+            # Modules of the cache that did import would shadow the parsed ones
+            for name, cached in list(sys.modules.items()):
+                if (getattr(cached, '__file__', None) or '').startswith(target + os.sep):
+                    del sys.modules[name]
+        Ice.loadSlice('', slice_include_args() + [slice])
+        module = import_murmur()
+        source = 'runtime parsing'
+    info('Loaded slice %s from %s in %.1fms', slice, source, (time.perf_counter() - start) * 1000)
+    return module
+
+
+#
+# --- Helper classes
+#
+def vars_of(cfg, section):
+    """
+    Returns the settings of a config section in a comparable form
+    """
+    value = cfg.__dict__.get(section.rstrip(':*'))
+    if isinstance(value, config):
+        return vars(value)
+    if isinstance(value, dict):
+        return dict((name, vars(v)) for name, v in value.items())
+    return value
+
+
+# Started with -q, only errors are logged whatever [log] level says
+log_quiet = False
+
+
+def apply_log_config():
+    """
+    Applies the log level and rate limit of the current configuration to
+    the already configured handlers
+    """
+    root = getLogger()
+    if not log_quiet:
+        root.setLevel(cfg.log.level)
+    for handler in root.handlers:
+        for f in [f for f in handler.filters if isinstance(f, rateLimitFilter)]:
+            handler.removeFilter(f)
+        if cfg.log.rate_limit > 0:
+            handler.addFilter(rateLimitFilter(cfg.log.rate_limit, cfg.log.rate_window))
+
+
+class config(object):
+    """
+    Small abstraction for config loading
+    """
+
+    def __init__(self, filename=None, default=None):
+        if not filename or not default:
+            return
+        cfg = configparser.ConfigParser()
+        cfg.optionxform = str
+        cfg.read(filename)
+
+        for h, v in default.items():
+            if not v:
+                # Output this whole section as a list of raw key/value tuples
+                try:
+                    self.__dict__[h] = cfg.items(h)
+                except configparser.NoSectionError:
+                    self.__dict__[h] = []
+            elif h.endswith(':*'):
+                # Output every section named prefix:<name> as a dict by name
+                prefix = h[:-1]
+                self.__dict__[h[:-2]] = dict((section[len(prefix):], self.section(cfg, section, v))
+                                             for section in cfg.sections() if section.startswith(prefix))
+            else:
+                self.__dict__[h] = self.section(cfg, h, v)
+
+    @staticmethod
+    def section(cfg, h, v):
+        section = config()
+        for name, conv, vdefault in v:
+            try:
+                section.__dict__[name] = conv(cfg.get(h, name))
+            except (ValueError, configparser.NoSectionError, configparser.NoOptionError):
+                section.__dict__[name] = vdefault
+        return section
+
+
+def entity_decode(string):
+    """
+    Python reverse implementation of php htmlspecialchars
+    """
+    htmlspecialchars = (('"', '&quot;'),
+                        ("'", '&#039;'),
+                        ('<', '&lt;'),
+                        ('>', '&gt'),
+                        ('&', '&amp;'))
+    ret = string
+    for (s, t) in htmlspecialchars:
+        ret = ret.replace(t, s)
+    return ret
+
+
+def entity_encode(string):
+    """
+    Python implementation of htmlspecialchars
+    """
+    htmlspecialchars = (('&', '&amp;'),
+                        ('"', '&quot;'),
+                        ("'", '&#039;'),
+                        ('<', '&lt;'),
+                        ('>', '&gt'))
+    ret = string
+    for (s, t) in htmlspecialchars:
+        ret = ret.replace(s, t)
+    return ret
+
+
+class traceSpan(object):
+    """
+    Timing of one step of a request
+    """
+
+    __slots__ = ('name', 'detail', 'start', 'duration', 'children')
+
+    def __init__(self, name, detail=None):
+        self.name = name
+        self.detail = detail
+        self.start = time.perf_counter()
+        self.duration = None
+        self.children = []
+
+    def as_dict(self):
+        ret = {'name': self.name, 'ms': round(self.duration * 1000, 2)}
+        if self.detail is not None:
+            ret['detail'] = self.detail
+        if self.children:
+            ret['children'] = [child.as_dict() for child in self.children]
+        return ret
+
+
+trace_state = threading.local()
+slow_log = getLogger('slowlog')
+
+
+class span(object):
+    """
+    Context manager timing a step as child of the request traced on this
+    thread, does nothing if there is none
+    """
+
+    __slots__ = ('span', 'parent')
+
+    def __init__(self, name, detail=None):
+        self.parent = getattr(trace_state, 'current', None)
+        self.span = None if self.parent is None else traceSpan(name, detail)
+
+    def __enter__(self):
+        if self.span is not None:
+            self.parent.children.append(self.span)
+            trace_state.current = self.span
+        return self
+
+    def __exit__(self, *exc):
+        if self.span is not None:
+            self.span.duration = time.perf_counter() - self.span.start
+            trace_state.current = self.parent
+        return False
+
+
+def traced(func):
+    """
+    Decorator that traces an Ice dispatch and writes the timing breakdown to
+    the slow log if it took longer than the configured threshold
+    """
+    if not cfg.trace.enabled:
+        return func
+
+    threshold = cfg.trace.slow_threshold / 1000.0
+
+    def newfunc(*args, **kws):
+        root = traceSpan(func.__name__, args[1] if len(args) > 1 and isinstance(args[1], (str, int)) else None)
+        trace_state.current = root
+        try:
+            return func(*args, **kws)
+        finally:
+            trace_state.current = None
+            root.duration = time.perf_counter() - root.start
+            if root.duration >= threshold:
+                slow_log.warning('%s', json.dumps(root.as_dict()))
+
+    return newfunc
+
+
+# Writes the slow log from a background thread with [log] async_write
+slow_log_listener = None
+
+
+def setup_slow_log():
+    global slow_log_listener
+    slow_log.propagate = False
+    slow_log.setLevel(logging.WARNING)
+    stop_slow_log()
+    for handler in slow_log.handlers[:]:
+        slow_log.removeHandler(handler)
+        handler.close()
+    handler = logging.FileHandler(cfg.trace.file) if cfg.trace.file else logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s SLOW %(message)s'))
+    if cfg.log.async_write:
+        # Slow requests are logged on Ice dispatch threads, like the main log
+        # they only queue the record
+        slow_log_listener = QueueListener(queue.Queue(cfg.log.queue_size), handler)
+        slow_log.addHandler(droppingQueueHandler(slow_log_listener.queue))
+        slow_log_listener.start()
+    else:
+        slow_log.addHandler(handler)
+
+
+def stop_slow_log():
+    global slow_log_listener
+    if slow_log_listener:
+        slow_log_listener.stop()
+        for handler in slow_log_listener.handlers:
+            handler.close()
+        slow_log_listener = None
+
+
+class admissionClass(object):
+    """
+    Concurrency limit for one class of Ice operations. Calls over the limit
+    are shed right away instead of parking an Ice thread, and all classes
+    but authentication are shed while they would take one of the threads
+    reserved for it.
+    """
+
+    def __init__(self, name, priority, limit):
+        self.name = name
+        self.priority = priority
+        self.limit = limit
+        self.active = 0
+        self.admitted = 0
+        self.shed = 0
+
+    def acquire(self):
+        with admission_lock:
+            if self.limit > 0 and self.active >= self.limit:
+                return self.reject('limit reached')
+            if self.priority > 0 and sum(c.active for c in admission_classes.values()
+                                         if c.priority > 0) >= admission_threads:
+                return self.reject('threads reserved for authentication')
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def reject(self, reason):
+        self.shed += 1
+        debug('Shedding %s call: %s', self.name, reason)
+        return False
+
+    def release(self):
+        with admission_lock:
+            self.active -= 1
+
+    def stats(self):
+        return {'limit': self.limit, 'active': self.active, 'admitted': self.admitted, 'shed': self.shed}
+
+
+# Operation classes by priority, authentication comes first
+admission_order = ('auth', 'lookup', 'callback', 'list', 'texture')
+admission_classes = {}
+admission_lock = threading.Lock()
+# Ice threads the classes below authentication may take together
+admission_threads = 1
+
+# Set when the shutdown drain starts, new calls get their fall through value
+draining = False
+
+
+def server_threads():
+    """
+    Most threads the Ice server thread pool dispatches calls on
+    """
+    if cfg.pool.enabled:
+        return cfg.pool.threads_max
+    properties = dict(cfg.iceraw)
+    return int(properties.get('Ice.ThreadPool.Server.SizeMax', properties.get('Ice.ThreadPool.Server.Size', 1)))
+
+
+def setup_admission():
+    global admission_classes, admission_threads
+    if not cfg.admission.enabled:
+        admission_classes = {}
+        return
+    admission_threads = max(1, server_threads() - cfg.admission.reserve)
+    admission_classes = dict((name, admissionClass(name, priority, getattr(cfg.admission, name)))
+                             for priority, name in enumerate(admission_order))
+    info('Admission control: %s, other classes share %d threads',
+         ', '.join('%s %d' % (name, c.limit) for name, c in sorted(admission_classes.items(),
+                                                                  key=lambda x: x[1].priority)),
+         admission_threads)
+
+
+def stop_admission():
+    """
+    Turns away new calls
+    """
+    global draining
+    draining = True
+
+
+class dispatchStats(object):
+    """
+    In-flight count and latency of the admitted Ice dispatches, sampled by
+    the pool controller
+    """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.threads = set()
+        self.peak = 0
+        self.count = 0
+        self.elapsed = 0.0
+
+    def begin(self):
+        with self.lock:
+            self.threads.add(thread.get_ident())
+            self.peak = max(self.peak, len(self.threads))
+
+    def end(self, start):
+        with self.lock:
+            self.threads.discard(thread.get_ident())
+            self.count += 1
+            self.elapsed += time.perf_counter() - start
+            if not self.threads:
+                self.lock.notify_all()
+
+    def wait_idle(self, deadline):
+        """
+        Waits till no dispatch is in flight, returns how many still are at
+        the monotonic deadline
+        """
+        with self.lock:
+            while self.threads:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+            return len(self.threads)
+
+    def sample(self):
+        """
+        Returns and resets the statistics since the last sample
+        """
+        with self.lock:
+            ret = {'in_flight': len(self.threads), 'peak': self.peak, 'count': self.count,
+                   'avg_ms': round(self.elapsed * 1000 / self.count, 1) if self.count else 0}
+            self.peak = len(self.threads)
+            self.count = 0
+            self.elapsed = 0.0
+        return ret
+
+
+dispatches = dispatchStats()
+
+
+def admitted(opclass, retval=None, shed=None):
+    """
+    Decorator passing a call through the admission control of its operation
+    class, shed calls and calls while draining return retval right away so
+    it has to be the fall through value of the operation. Operations without
+    one give shed, called with the arguments of a shed call instead.
+    """
+
+    def newdec(func):
+        def newfunc(*args, **kws):
+            # Murmur falls back on the same value while we detach, session
+            # callbacks still run and have their writes deferred
+            if draining and opclass != 'callback':
+                return retval
+            admission = admission_classes.get(opclass)
+            if admission is not None and not admission.acquire():
+                if shed is not None:
+                    shed(*args, **kws)
+                return retval
+            dispatches.begin()
+            start = time.perf_counter()
+            try:
+                return func(*args, **kws)
+            finally:
+                dispatches.end(start)
+                if admission is not None:
+                    admission.release()
+
+        return newfunc
+
+    return newdec
+
+
+def fortifyIceFu(retval=None, exceptions=(Ice.Exception,)):
+    """
+    Decorator that catches exceptions,logs them and returns a safe retval
+    value. This helps preventing the authenticator getting stuck in
+    critical code paths. Only exceptions that are instances of classes
+    given in the exceptions list are not caught.
+
+    The default is to catch all non-Ice exceptions.
+    """
+
+    def newdec(func):
+        def newfunc(*args, **kws):
+            try:
+                return func(*args, **kws)
+            except Exception as e:
+                catch = True
+                for ex in exceptions:
+                    if isinstance(e, ex):
+                        catch = False
+                        break
+
+                if catch:
+                    critical('Unexpected exception caught')
+                    exception(e)
+                    return retval
+                raise
+
+        return newfunc
+
+    return newdec
+
+
+# Secret expected on calls by Ice identity name of the called servant, every
+# Meta endpoint registers the shared servants under identities of its own
+servant_secrets = {}
+
+
+def secret_checker(invalid):
+    """
+    Returns the checkSecret decorator, raising invalid on a wrong secret.
+    The exception comes from the slice loaded in do_main_program.
+    """
+
+    def checkSecret(func):
+        """
+        Decorator that checks whether the server transmitted the right secret
+        if a secret is supposed to be used. With several Meta endpoints the
+        secret of the endpoint the called servant was registered for is
+        expected, unknown servants expect the [ice] secret.
+        """
+        if not any([cfg.ice.secret] + [meta.secret for meta in cfg.meta.values()]):
+            return func
+
+        def newfunc(*args, **kws):
+            if 'current' in kws:
+                current = kws["current"]
+            else:
+                current = args[-1]
+
+            secret = cfg.ice.secret
+            if current:
+                secret = servant_secrets.get(current.id.name, secret)
+            if not secret:
+                # This endpoint has no secret configured
+                return func(*args, **kws)
+
+            with span('checkSecret'):
+                valid = current and current.ctx.get('secret') == secret
+            if not valid:
+                error('Server transmitted invalid secret. Possible injection attempt.')
+                raise invalid()
+
+            return func(*args, **kws)
+
+        return newfunc
+
+    return checkSecret
+
+
+class threadDbException(Exception):
+    pass
+
+
+class concurrencyGate(object):
+    """
+    Adjustable limit of concurrent database queries, callers wait at most
+    wait seconds for a free slot
+    """
+
+    def __init__(self, limit, wait):
+        self.limit = limit
+        self.wait = wait
+        self.active = 0
+        self.waiting = 0
+        self.peak = 0
+        self.peak_waiting = 0
+        self.rejected = 0
+        self.count = 0
+        self.elapsed = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            if self.active >= self.limit:
+                self.waiting += 1
+                self.peak_waiting = max(self.peak_waiting, self.waiting)
+                try:
+                    with span('db slot'):
+                        free = self.cond.wait_for(lambda: self.active < self.limit, self.wait)
+                finally:
+                    self.waiting -= 1
+                if not free:
+                    self.rejected += 1
+                    return None
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        return time.perf_counter()
+
+    def release(self, start):
+        with self.cond:
+            self.active -= 1
+            self.count += 1
+            self.elapsed += time.perf_counter() - start
+            self.cond.notify()
+
+    def resize(self, limit):
+        with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+    def sample(self):
+        """
+        Returns and resets the statistics since the last sample
+        """
+        with self.cond:
+            ret = {'limit': self.limit, 'active': self.active, 'peak': self.peak,
+                   'waiting': self.waiting, 'peak_waiting': self.peak_waiting, 'rejected': self.rejected,
+                   'avg_ms': round(self.elapsed * 1000 / self.count, 1) if self.count else 0}
+            self.peak = self.active
+            self.peak_waiting = self.waiting
+            self.rejected = 0
+            self.count = 0
+            self.elapsed = 0.0
+        return ret
+
+
+class circuitBreaker(object):
+    """
+    Circuit breaker guarding a database host.
+
+    After `threshold` consecutive failures the breaker opens and every call
+    fails fast. Once the backoff delay has passed a single probe call is let
+    through (half-open). A successful probe closes the breaker again, a
+    failed one re-opens it with twice the previous delay up to `backoff_max`.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, threshold=3, backoff=1.0, backoff_max=60.0):
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.backoff = backoff
+        self.backoff_max = max(backoff, backoff_max)
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.delay = backoff
+        self.retry_at = 0
+        self.probing = False
+
+    def allow(self):
+        """
+        Returns whether a call may go ahead
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() < self.retry_at:
+                    return False
+                debug('Circuit breaker for %s half-open, probing', self.name)
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.probing:
+                # Only a single probe at a time while half-open
+                return False
+            self.probing = True
+            return True
+
+    def cancel_probe(self):
+        """
+        Gives back a probe that allow() let through but that never reached
+        the host, so the next call may probe instead
+        """
+        with self.lock:
+            self.probing = False
+
+    def success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                info('Circuit breaker for %s closed', self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+            self.delay = self.backoff
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.delay = min(self.delay * 2, self.backoff_max)
+            elif self.state == self.OPEN or self.failures < self.threshold:
+                return
+            else:
+                self.delay = self.backoff
+            self.state = self.OPEN
+            self.probing = False
+            self.retry_at = time.monotonic() + self.delay
+            warning('Circuit breaker for %s opened after %d failures, next probe in %.1fs',
+                    self.name, self.failures, self.delay)
+
+
+class dbBackend(abc.ABC):
+    """
+    A DB-API driver behind the few operations the authenticator needs:
+    connecting, executing single and batched statements, telling lost
+    connections apart from failed statements and explaining queries.
+    Statements use the %s placeholders of the MySQL drivers.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.Error = module.Error
+        self.OperationalError = module.OperationalError
+        self.InterfaceError = module.InterfaceError
+
+    @abc.abstractmethod
+    def connect(self, host, port):
+        pass
+
+    def execute(self, cursor, sql, args=None):
+        if args is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql, args)
+
+    def executemany(self, cursor, sql, rows):
+        cursor.executemany(sql, rows)
+
+    # MySQL server errors besides the 2xxx client errors that mean the
+    # connection broke or the statement may succeed when retried
+    lost_codes = (1040, 1053, 1152, 1158, 1159, 1160, 1161, 1205, 1213, 1927)
+
+    def connection_lost(self, e):
+        """
+        Whether the error leaves the connection unusable, so the statement
+        is worth retrying on a new one
+        """
+        # The MySQL drivers raise InterfaceError on a connection that is
+        # already closed, e.g. after the server dropped it
+        if isinstance(e, self.InterfaceError):
+            return True
+        if not isinstance(e, self.OperationalError):
+            return False
+        code = e.args[0] if e.args and isinstance(e.args[0], int) else None
+        return code is None or 2000 <= code < 3000 or code in self.lost_codes
+
+    def describe(self, e):
+        return ': '.join(str(arg) for arg in e.args)
+
+    def explain(self, cursor, sql, args):
+        """
+        Returns the query plan as rows with table, type, key and rows in the
+        terms of MySQL's EXPLAIN
+        """
+        self.execute(cursor, 'EXPLAIN ' + sql, args)
+        columns = [d[0] for d in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+
+class mysqldbBackend(dbBackend):
+    def connect(self, host, port):
+        con = self.module.connect(host=host,
+                                  port=port,
+                                  user=cfg.database.user,
+                                  passwd=cfg.database.password,
+                                  db=cfg.database.name,
+                                  charset='utf8')
+        # Transactional engines like InnoDB initiate a transaction even
+        # on SELECTs-only.
+        # Thus, we auto-commit so Authenticator gets recent data.
+        con.autocommit(True)
+        return con
+
+
+class pymysqlBackend(dbBackend):
+    def connect(self, host, port):
+        return self.module.connect(host=host,
+                                   port=port,
+                                   user=cfg.database.user,
+                                   password=cfg.database.password,
+                                   database=cfg.database.name,
+                                   charset='utf8',
+                                   autocommit=True)
+
+
+class sqliteBackend(dbBackend):
+    """
+    SQLite database file given as [database] name, a local stand-in for
+    MySQL to run the authenticator and benchmarks without a server
+    """
+
+    schema = ('CREATE TABLE IF NOT EXISTS %smumble_mumbleuser ('
+              '`id` INTEGER PRIMARY KEY, `username` VARCHAR(254) NOT NULL UNIQUE, '
+              '`pwhash` VARCHAR(90) NOT NULL, `hashfn` VARCHAR(20) NOT NULL, `groups` TEXT, '
+              '`user_id` INTEGER UNIQUE, `display_name` VARCHAR(254) UNIQUE, `release` TEXT, '
+              '`version` INTEGER, `last_connect` DATETIME, `last_disconnect` DATETIME)',
+              'CREATE TABLE IF NOT EXISTS %sauthentication_userprofile ('
+              '`id` INTEGER PRIMARY KEY, `user_id` INTEGER NOT NULL UNIQUE, `main_character_id` INTEGER UNIQUE)',
+              'CREATE TABLE IF NOT EXISTS %seveonline_evecharacter ('
+              '`id` INTEGER PRIMARY KEY, `character_id` INTEGER NOT NULL UNIQUE, `character_name` VARCHAR(254))')
+
+    def connect(self, host, port):
+        # Stale connections of threads that are gone are closed from another
+        # thread, spare connections are taken over by another thread
+        return self.module.connect(cfg.database.name, check_same_thread=False, isolation_level=None)
+
+    def execute(self, cursor, sql, args=None):
+        dbBackend.execute(self, cursor, sql.replace('%s', '?'), args)
+
+    def connection_lost(self, e):
+        # SQLite reports bad statements as OperationalError as well
+        message = str(e)
+        return isinstance(e, self.OperationalError) and (
+            'locked' in message or 'unable to open' in message or 'disk I/O' in message)
+
+    def executemany(self, cursor, sql, rows):
+        cursor.executemany(sql.replace('%s', '?'), rows)
+
+    def explain(self, cursor, sql, args):
+        self.execute(cursor, 'EXPLAIN QUERY PLAN ' + sql, args)
+        plan = []
+        for row in cursor:
+            # e.g. SCAN aa_mumble_mumbleuser or SEARCH aup USING INDEX name (user_id=?)
+            detail = row[-1].split(' (')[0]
+            words = detail.replace(' TABLE ', ' ', 1).split()
+            if len(words) < 2 or words[0] not in ('SCAN', 'SEARCH'):
+                continue
+            key = detail.split(' USING ', 1)[1] if ' USING ' in detail else None
+            if words[0] == 'SEARCH':
+                kind = 'ref'
+            else:
+                kind = 'index' if key else 'ALL'
+            plan.append({'table': words[1], 'type': kind, 'key': key, 'rows': None})
+        return plan
+
+    def create_schema(self):
+        """
+        Creates the Alliance Auth tables the authenticator uses
+        """
+        con = self.connect(None, None)
+        try:
+            for statement in self.schema:
+                con.execute(statement % cfg.database.prefix)
+        finally:
+            con.close()
+
+
+backends = {'MySQLdb': mysqldbBackend,
+            'pymysql': pymysqlBackend,
+            'sqlite3': sqliteBackend}
+
+
+def load_backend(lib):
+    """
+    Imports the database library and wraps it, other libraries than the
+    known ones have to take MySQLdb style connect arguments
+    """
+    return backends.get(lib, mysqldbBackend)(__import__(lib))
+
+
+class dbHost(object):
+    """
+    A database server the authenticator can send queries to
+    """
+
+    def __init__(self, name, host, port):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.breaker = circuitBreaker(name,
+                                      cfg.database.breaker_threshold,
+                                      cfg.database.breaker_backoff,
+                                      cfg.database.breaker_backoff_max)
+        # Replicas start out unhealthy until the first health check passed
+        self.healthy = name == 'primary'
+        self.lag = None
+
+    def connect(self):
+        return db.connect(self.host, self.port)
+
+
+class threadDB(object):
+    """
+    Small abstraction to handle database connections for multiple
+    threads
+    """
+
+    db_connections = {}
+    stale_connections = {}
+    spare_connections = {}
+    last_used = {}
+    gate = None
+    primary = None
+    replicas = []
+    next_replica = itertools.count()
+
+    def setup(cls):
+        """
+        (Re)creates the primary and replica hosts from the configuration
+        """
+        # Connections may be in use right now, their threads close them on their next query
+        connections, cls.db_connections = cls.db_connections, {}
+        cls.stale_connections.update(connections)
+        cls.close_spares()
+        cls.primary = dbHost('primary', cfg.database.host, cfg.database.port)
+        cls.replicas = [dbHost('replica %s:%d' % (host, port), host, port)
+                        for host, port in cfg.database.replicas]
+
+    setup = classmethod(setup)
+
+    def connection(cls, target=None):
+        target = target or cls.primary
+        tid = thread.get_ident()
+        if cls.stale_connections:
+            cls.release(cls.stale_connections)
+        # Mark the connection used before taking it, trim() relies on that
+        cls.last_used[(tid, target.name)] = time.monotonic()
+        try:
+            con = cls.db_connections[(tid, target.name)]
+        except:
+            con = cls.take_spare(target, tid)
+            if con is None:
+                con = cls.open(target, tid)
+            cls.db_connections[(tid, target.name)] = con
+        return con
+
+    connection = classmethod(connection)
+
+    def open(cls, target, tid):
+        info('Connecting to database server (%s %s:%d %s) for thread %d',
+             cfg.database.lib,
+             target.host,
+             target.port,
+             cfg.database.name,
+             tid)
+
+        try:
+            return target.connect()
+        except db.Error as e:
+            error('Could not connect to database: %s', str(e))
+            raise threadDbException()
+
+    open = classmethod(open)
+
+    def prefill(cls, count, deadline):
+        """
+        Opens spare connections to the primary up to count, taken over by
+        threads without a connection of their own. Stops at the monotonic
+        deadline, returns how many spares there are.
+        """
+        spares = cls.spare_connections.setdefault(cls.primary.name, [])
+        while len(spares) < count and time.monotonic() < deadline:
+            spares.append((time.monotonic(), cls.open(cls.primary, thread.get_ident())))
+        return len(spares)
+
+    prefill = classmethod(prefill)
+
+    def take_spare(cls, target, tid):
+        """
+        Returns a spare connection opened ahead by the warm-up, or None.
+        Spares older than [pool] idle_timeout are closed instead, like trim
+        retires idle connections, the server may have dropped them already.
+        """
+        spares = cls.spare_connections.get(target.name, [])
+        while True:
+            try:
+                opened, con = spares.pop()
+            except IndexError:
+                return None
+            if time.monotonic() - opened < cfg.pool.idle_timeout:
+                debug('Taking spare database connection to %s for thread %d', target.name, tid)
+                return con
+            debug('Closing idle spare database connection to %s', target.name)
+            con.close()
+
+    take_spare = classmethod(take_spare)
+
+    def close_spares(cls):
+        spares, cls.spare_connections = cls.spare_connections, {}
+        for connections in spares.values():
+            for opened, con in connections:
+                con.close()
+
+    close_spares = classmethod(close_spares)
+
+    def cursor(cls, target=None):
+        return cls.connection(target).cursor()
+
+    cursor = classmethod(cursor)
+
+    def execute(cls, *args, **kwargs):
+        """
+        Executes a query on the primary database server
+        """
+        return cls.execute_on(cls.primary, *args, **kwargs)
+
+    execute = classmethod(execute)
+
+    def execute_many(cls, sql, rows):
+        """
+        Executes a statement once for every row of parameters in one batch
+        on the primary database server
+        """
+        return cls.execute_on(cls.primary, sql, rows, threadDB__many__=True)
+
+    execute_many = classmethod(execute_many)
+
+    def read(cls, *args, **kwargs):
+        """
+        Executes a read-only query on a healthy replica, falling back to
+        the primary if no replica is available or the replica failed
+        """
+        healthy = [r for r in cls.replicas if r.healthy]
+        if healthy:
+            target = healthy[next(cls.next_replica) % len(healthy)]
+            try:
+                return cls.execute_on(target, *args, **kwargs)
+            except threadDbException:
+                debug('Read from %s failed, falling back to primary', target.name)
+        return cls.execute_on(cls.primary, *args, **kwargs)
+
+    read = classmethod(read)
+
+    def execute_on(cls, target, *args, **kwargs):
+        many = kwargs.pop("threadDB__many__", False)
+        if "threadDB__retry_execution__" in kwargs:
+            # Have a magic keyword so we can call ourselves while preventing
+            # an infinite loop
+            del kwargs["threadDB__retry_execution__"]
+            retry = False
+        else:
+            retry = True
+            if not target.breaker.allow():
+                # Fail fast instead of waiting on a host we know is down
+                debug('Database circuit breaker for %s open, failing fast', target.name)
+                raise threadDbException()
+
+        # The retry runs within the slot of the first attempt
+        gate = cls.gate if retry else None
+        if gate is not None:
+            start = gate.acquire()
+            if start is None:
+                debug('No database slot free within %.1fs, failing fast', gate.wait)
+                target.breaker.cancel_probe()
+                raise threadDbException()
+
+        try:
+            try:
+                c = cls.cursor(target)
+            except threadDbException:
+                target.breaker.failure()
+                raise
+            try:
+                with span('db', target.name):
+                    if many:
+                        db.executemany(c, *args, **kwargs)
+                    else:
+                        db.execute(c, *args, **kwargs)
+            except db.Error as e:
+                if not db.connection_lost(e):
+                    # The server answered, the statement itself failed
+                    target.breaker.success()
+                    error('Database error %s', db.describe(e))
+                    c.close()
+                    raise threadDbException()
+                error('Database operational error %s', db.describe(e))
+                c.close()
+                cls.invalidate_connection(target)
+                if retry:
+                    # Make sure we only retry once
+                    info('Retrying database operation')
+                    kwargs["threadDB__retry_execution__"] = True
+                    kwargs["threadDB__many__"] = many
+                    c = cls.execute_on(target, *args, **kwargs)
+                else:
+                    error('Database operation failed ultimately')
+                    target.breaker.failure()
+                    raise threadDbException()
+            except Exception:
+                # Anything else still means the server answered us
+                target.breaker.success()
+                raise
+            else:
+                target.breaker.success()
+            return c
+        finally:
+            if gate is not None:
+                gate.release(start)
+
+    execute_on = classmethod(execute_on)
+
+    def invalidate_connection(cls, target=None):
+        target = target or cls.primary
+        tid = thread.get_ident()
+        con = cls.db_connections.pop((tid, target.name), None)
+        cls.last_used.pop((tid, target.name), None)
+        if con:
+            debug('Invalidate connection to database for thread %d', tid)
+            con.close()
+
+    invalidate_connection = classmethod(invalidate_connection)
+
+    def release(cls, connections=None):
+        """
+        Closes all connections of the current thread, to be called by short
+        lived threads like timers before they exit
+        """
+        if connections is None:
+            connections = cls.db_connections
+        tid = thread.get_ident()
+        for key in [k for k in list(connections) if k[0] == tid]:
+            con = connections.pop(key, None)
+            if con:
+                con.close()
+            if key not in cls.db_connections:
+                cls.last_used.pop(key, None)
+
+    release = classmethod(release)
+
+    def trim(cls, keep, idle, busy):
+        """
+        Retires connections unused for idle seconds, and the least recently
+        used ones beyond keep, skipping threads in the busy set. Retired
+        connections are closed by their own thread on its next query, see
+        close_stale for threads that do not come back.
+        """
+        # Retired in an earlier run, their threads had a chance to close them
+        closed = cls.close_stale(idle, busy)
+        now = time.monotonic()
+        candidates = sorted((cls.last_used.get(key, 0), key) for key in list(cls.db_connections)
+                            if key[0] not in busy)
+        excess = len(cls.db_connections) - keep
+        for used, key in candidates:
+            if now - used < idle and (excess <= 0 or now - used < cfg.pool.interval):
+                continue
+            con = cls.db_connections.pop(key, None)
+            if con is None:
+                continue
+            if cls.last_used.get(key, 0) != used:
+                # Its thread picked it up meanwhile, hand it back
+                if cls.db_connections.setdefault(key, con) is not con:
+                    con.close()
+                continue
+            debug('Retiring idle database connection to %s for thread %d', key[1], key[0])
+            cls.stale_connections[key] = con
+            excess -= 1
+        return closed
+
+    trim = classmethod(trim)
+
+    def close_stale(cls, idle, busy=()):
+        """
+        Closes retired connections whose thread did not use the database
+        for idle seconds, most likely the thread is gone. Returns how many
+        were closed.
+        """
+        now = time.monotonic()
+        closed = 0
+        for key in list(cls.stale_connections):
+            if key[0] in busy or now - cls.last_used.get(key, 0) < idle:
+                continue
+            con = cls.stale_connections.pop(key, None)
+            if con is None:
+                continue
+            debug('Closing stale database connection to %s for thread %d', key[1], key[0])
+            con.close()
+            if key not in cls.db_connections:
+                cls.last_used.pop(key, None)
+            closed += 1
+        return closed
+
+    close_stale = classmethod(close_stale)
+
+    def disconnect(cls):
+        for connections in (cls.db_connections, cls.stale_connections):
+            while connections:
+                (tid, name), con = connections.popitem()
+                debug('Close database connection to %s for thread %d', name, tid)
+                con.close()
+        cls.last_used.clear()
+        cls.close_spares()
+
+    disconnect = classmethod(disconnect)
+
+
+class sessionWrites(object):
+    """
+    Bookkeeping updates from the session callbacks. While draining they are
+    queued instead and flushed in one batch per statement before the
+    database connections are closed. Updates of shed callbacks are queued
+    too and written along with the next admitted one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.deferred = False
+        self.pending = {}
+
+    def execute(self, sql, args):
+        with self.lock:
+            if self.deferred:
+                self.pending.setdefault(sql, []).append(args)
+                return
+            backlog = bool(self.pending)
+        cur = threadDB.execute(sql, args)
+        cur.close()
+        if backlog:
+            self.flush()
+
+    def queue(self, sql, args):
+        with self.lock:
+            self.pending.setdefault(sql, []).append(args)
+
+    def defer(self):
+        with self.lock:
+            self.deferred = True
+
+    def count(self):
+        with self.lock:
+            return sum(len(rows) for rows in self.pending.values())
+
+    def flush(self):
+        """
+        Writes the queued updates, returns how many there were
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for sql, rows in pending.items():
+            cur = threadDB.execute_many(sql, rows)
+            cur.close()
+        return sum(len(rows) for rows in pending.values())
+
+
+session_writes = sessionWrites()
+
+
+def connected_update(user):
+    sql = 'UPDATE %smumble_mumbleuser ' \
+          'SET `release` = %%s, `version` = %%s, `last_connect` = %%s ' \
+          'WHERE `user_id` = %%s' % cfg.database.prefix
+    return sql, [user.release,
+                 user.version,
+                 datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                 user.userid - cfg.user.id_offset]
+
+
+def disconnected_update(user):
+    sql = 'UPDATE %smumble_mumbleuser ' \
+          'SET `last_disconnect` = %%s ' \
+          'WHERE user_id = %%s' % cfg.database.prefix
+    return sql, [datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                 user.userid - cfg.user.id_offset]
+
+
+def queued(update):
+    """
+    Shed handler for a session callback, queues its update instead of
+    losing it
+    """
+
+    def shed(servant, user, current=None):
+        session_writes.queue(*update(user))
+
+    return shed
+
+
+def check_replicas(generation):
+    """
+    Health checks all replicas and takes the ones that are unreachable or
+    lag too far behind the primary out of the read rotation. Runs until
+    restart_replica_checks starts a new generation.
+    """
+    global replica_timer
+    try:
+        for replica in threadDB.replicas:
+            lag = None
+            try:
+                con = replica.connect()
+                try:
+                    cur = con.cursor()
+                    cur.execute('SHOW SLAVE STATUS')
+                    row = cur.fetchone()
+                    if row is None:
+                        # Not replicating at all, e.g. a read-only mirror
+                        lag = 0
+                    else:
+                        columns = [d[0] for d in cur.description]
+                        lag = row[columns.index('Seconds_Behind_Master')]
+                    cur.close()
+                finally:
+                    con.close()
+            except db.Error as e:
+                debug('Replica health check for %s failed: %s', replica.name, str(e))
+            except Exception:
+                # Anything else, e.g. a driver bug or an unexpected status row,
+                # still only takes this replica out of the rotation
+                warning('Replica health check for %s failed unexpectedly', replica.name)
+                debug(traceback.format_exc())
+
+            healthy = lag is not None and lag <= cfg.database.replica_max_lag
+            if healthy != replica.healthy:
+                if healthy:
+                    info('Adding %s to the read rotation (lag %ds)', replica.name, lag)
+                else:
+                    warning('Removing %s from the read rotation (lag %s)', replica.name, lag)
+            replica.healthy = healthy
+            replica.lag = lag
+    finally:
+        # Always reschedule, a dead checker would freeze the rotation as it is
+        if generation == replica_generation:
+            replica_timer = Timer(cfg.database.replica_check_interval, check_replicas, (generation,))
+            replica_timer.daemon = True
+            replica_timer.start()
+
+
+replica_timer = None
+# A check running during a restart sees the new generation and does not reschedule
+replica_generation = 0
+
+
+def restart_replica_checks():
+    global replica_generation
+    replica_generation += 1
+    if replica_timer is not None:
+        replica_timer.cancel()
+    if threadDB.replicas:
+        info('Routing reads to %d database replica(s)', len(threadDB.replicas))
+        check_replicas(replica_generation)
+
+
+class poolController(object):
+    """
+    Adapts the database concurrency limit to the observed load and closes
+    idle connections. The Ice server thread pool grows and shrinks on its
+    own between threads_min and threads_max, Ice can not change these
+    bounds at runtime so they are only reported on.
+    """
+
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.quiet = 0
+        self.report = {}
+
+    def start(self):
+        threadDB.gate = concurrencyGate(cfg.pool.db_min, cfg.pool.db_wait)
+        threading.Thread(target=self.loop, name='PoolController', daemon=True).start()
+        info('Pool controller started, database limit %d-%d, Ice threads %d-%d',
+             cfg.pool.db_min, cfg.pool.db_max, cfg.pool.threads_min, cfg.pool.threads_max)
+
+    def stop(self):
+        self.stopped.set()
+        threadDB.gate = None
+
+    def loop(self):
+        while not self.stopped.wait(cfg.pool.interval):
+            try:
+                self.adjust()
+            except Exception as e:
+                exception(e)
+
+    def adjust(self):
+        gate = threadDB.gate
+        if gate is None:
+            return
+        ice = dispatches.sample()
+        database = gate.sample()
+        limit = gate.limit
+        step = max(1, limit // 4)
+
+        if database['peak_waiting'] or database['rejected']:
+            if database['avg_ms'] <= cfg.pool.target_latency:
+                limit, reason = min(cfg.pool.db_max, limit + step), 'queries queued'
+            else:
+                reason = 'queries queued but the database is slow'
+        elif database['avg_ms'] > cfg.pool.target_latency and database['peak'] >= limit:
+            limit, reason = max(cfg.pool.db_min, limit - step), 'database slow'
+        elif database['peak'] <= limit // 2:
+            self.quiet += 1
+            if self.quiet >= 3:
+                limit, reason = max(cfg.pool.db_min, limit - 1), 'quiet'
+                self.quiet = 0
+        else:
+            self.quiet = 0
+
+        if limit != gate.limit:
+            info('Database concurrency limit %d -> %d (%s, peak %d, %d queued, %.1fms per query)',
+                 gate.limit, limit, reason, database['peak'], database['peak_waiting'], database['avg_ms'])
+            gate.resize(limit)
+            database['limit'] = limit
+
+        if ice['peak'] >= cfg.pool.threads_max:
+            warning('All %d Ice server threads were busy, consider raising [pool] threads_max',
+                    cfg.pool.threads_max)
+
+        closed = threadDB.trim(limit, cfg.pool.idle_timeout, dispatches.threads)
+        self.report = {'ice': dict(ice, threads_min=cfg.pool.threads_min, threads_max=cfg.pool.threads_max),
+                       'database': dict(database, connections=len(threadDB.db_connections),
+                                        stale=len(threadDB.stale_connections), closed=closed),
+                       'sampled_at': datetime.datetime.now().isoformat()}
+        debug('Pool sample: %s', json.dumps(self.report))
+
+
+pool_controller = None
+
+
+def sweep_stale_connections(idle):
+    """
+    Closes the connections retired by threadDB.setup whose threads did not
+    come back within idle seconds, for when no pool controller trims them
+    """
+    if pool_controller is not None:
+        return
+    threadDB.close_stale(idle, dispatches.threads)
+    if threadDB.stale_connections:
+        timer = Timer(idle, sweep_stale_connections, (idle,))
+        timer.daemon = True
+        timer.start()
+
+
+def restart_pool_controller():
+    global pool_controller
+    if pool_controller is not None:
+        pool_controller.stop()
+        pool_controller = None
+    if cfg.pool.enabled:
+        pool_controller = poolController()
+        pool_controller.start()
+
+
+def hot_queries(username, user_id):
+    """
+    The statements the authenticator runs per request, with parameters and
+    the index each of them depends on
+    """
+    prefix = cfg.database.prefix
+    return [('authenticate',
+             'SELECT `user_id`, `pwhash`, `groups`, `hashfn` '
+             'FROM %smumble_mumbleuser WHERE `username` = %%s' % prefix,
+             [username], '%smumble_mumbleuser.username' % prefix),
+            ('display name',
+             'SELECT `display_name`, `user_id` FROM %smumble_mumbleuser WHERE `username` = %%s' % prefix,
+             [username], '%smumble_mumbleuser.username' % prefix),
+            ('nameToId',
+             'SELECT user_id FROM %smumble_mumbleuser WHERE username = %%s' % prefix,
+             [username], '%smumble_mumbleuser.username' % prefix),
+            ('idToName',
+             'SELECT username FROM %smumble_mumbleuser WHERE user_id = %%s' % prefix,
+             [user_id], '%smumble_mumbleuser.user_id' % prefix),
+            ('userConnected',
+             'UPDATE %smumble_mumbleuser SET `release` = %%s, `version` = %%s, `last_connect` = %%s '
+             'WHERE `user_id` = %%s' % prefix,
+             ['', 0, None, user_id], '%smumble_mumbleuser.user_id' % prefix),
+            ('main characters',
+             'SELECT aup.user_id, eec.character_id '
+             'FROM %sauthentication_userprofile AS `aup` '
+             'JOIN %seveonline_evecharacter AS `eec` ON aup.main_character_id = eec.id '
+             'WHERE aup.user_id IN (%%s)' % (prefix, prefix),
+             [user_id], '%sauthentication_userprofile.user_id' % prefix)]
+
+
+# Result of the last query plan check by statement name
+query_plans = {}
+
+
+def advise_indexes():
+    """
+    Runs EXPLAIN on the per request statements and warns about full table
+    scans, e.g. on installs missing the indexes Alliance Auth creates
+    """
+    global query_plans
+    plans = {}
+    try:
+        cur = threadDB.execute('SELECT `username`, `user_id` FROM %smumble_mumbleuser LIMIT 1'
+                               % cfg.database.prefix)
+        sample = cur.fetchone() or ('', 0)
+        cur.close()
+    except (threadDbException, db.Error) as e:
+        warning('Could not check the query plans: %s', str(e))
+        threadDB.release()
+        return
+
+    for name, sql, args, index in hot_queries(*sample):
+        try:
+            cur = threadDB.cursor()
+            try:
+                rows = db.explain(cur, sql, args)
+            finally:
+                cur.close()
+        except (threadDbException, db.Error) as e:
+            debug('Could not explain %s: %s', name, str(e))
+            plans[name] = {'ok': None, 'error': str(e)}
+            continue
+
+        # ALL and index mean every row of the table or index is read
+        scans = [row['table'] for row in rows if row.get('type') in ('ALL', 'index')]
+        estimate = 1
+        for row in rows:
+            estimate *= row.get('rows') or 1
+        plans[name] = {'ok': not scans, 'rows': estimate,
+                       'plan': [{'table': row.get('table'), 'type': row.get('type'), 'key': row.get('key'),
+                                 'rows': row.get('rows')} for row in rows]}
+        if scans:
+            warning('Query plan: %s scans the whole %s table (about %d rows) on every request, '
+                    'check that %s is indexed', name, ', '.join(scans), estimate, index)
+        else:
+            info('Query plan: %s uses %s, about %d rows', name,
+                 ', '.join('%s' % row.get('key') for row in rows if row.get('key')) or 'no table', estimate)
+
+    query_plans = plans
+    threadDB.release()
+
+
+class userCache(object):
+    """
+    Compact in-process copy of the registered users.
+
+    Users are stored column-wise, sorted by user id, instead of as one Python
+    object per user. Group names are interned into a table and every user
+    only references a deduplicated set of small integer group ids, a trigram
+    index over the usernames answers substring searches for getRegisteredUsers
+    without a table scan.
+
+    Every group set also has a precomputed tuple of group names which is
+    shared by all users with the same groups and handed to Murmur as is.
+    """
+
+    def __init__(self, rows=()):
+        self.loaded_at = time.time()
+        self.ids = array('q')
+        self.names = []
+        self.display_names = []
+        self.group_sets = array('I')
+        self.sets = []
+        self.set_groups = []
+        self.set_ids = {}
+        self.group_names = []
+        self.group_ids = {}
+        self.grams = {}
+        for uid, name, display_name, groups in rows:
+            pos = len(self.names)
+            self.ids.append(uid)
+            self.names.append(name)
+            folded = name.casefold()
+            self.display_names.append(display_name if display_name and display_name != name else None)
+            self.group_sets.append(self.intern_groups(groups))
+            for gram in set(folded[i:i + 3] for i in range(len(folded) - 2)):
+                try:
+                    self.grams[gram].append(pos)
+                except KeyError:
+                    self.grams[gram] = array('I', (pos,))
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern_groups(self, groups):
+        """
+        Returns the id of the group set for a comma separated groups string
+        """
+        try:
+            return self.set_ids[groups]
+        except KeyError:
+            pass
+        gids = []
+        for group in groups.split(',') if groups else ():
+            try:
+                gids.append(self.group_ids[group])
+            except KeyError:
+                self.group_ids[group] = len(self.group_names)
+                gids.append(len(self.group_names))
+                self.group_names.append(sys.intern(group))
+        self.set_ids[groups] = len(self.sets)
+        self.sets.append(array('H', gids))
+        self.set_groups.append(tuple(self.group_names[g] for g in gids))
+        return self.set_ids[groups]
+
+    def groups(self, groups):
+        """
+        Returns the shared group tuple for a comma separated groups string
+        or None if no cached user has exactly these groups
+        """
+        set_id = self.set_ids.get(groups)
+        if set_id is None:
+            return None
+        return self.set_groups[set_id]
+
+    def position(self, user_id):
+        pos = bisect_left(self.ids, user_id)
+        if pos < len(self.ids) and self.ids[pos] == user_id:
+            return pos
+        return None
+
+    def get(self, user_id):
+        """
+        Returns (username, display_name, groups) for a user id or None if unknown
+        """
+        pos = self.position(user_id)
+        if pos is None:
+            return None
+        name = self.names[pos]
+        return name, self.display_names[pos] or name, self.set_groups[self.group_sets[pos]]
+
+    def search(self, filter):
+        """
+        Yields (user_id, username) for every username containing filter,
+        case insensitive like the MySQL default collation. Filters with LIKE
+        wildcards match as LIKE patterns, as they would in the database.
+        """
+        if '%' in filter or '_' in filter:
+            pattern, literal = like_pattern(filter)
+            for pos in self.candidates(literal):
+                if pattern.match(self.names[pos]):
+                    yield self.ids[pos], self.names[pos]
+            return
+
+        needle = filter.casefold()
+        if not needle:
+            for pos in range(len(self.names)):
+                yield self.ids[pos], self.names[pos]
+            return
+
+        for pos in self.candidates(needle):
+            # Folding on the fly only for candidates is cheaper than keeping a copy
+            if needle in self.names[pos].casefold():
+                yield self.ids[pos], self.names[pos]
+
+    def candidates(self, needle):
+        """
+        Positions of the usernames that may contain the folded needle,
+        judging by its trigrams
+        """
+        if len(needle) < 3:
+            return range(len(self.names))
+        postings = []
+        for i in range(len(needle) - 2):
+            posting = self.grams.get(needle[i:i + 3])
+            if posting is None:
+                return ()
+            postings.append(posting)
+        return min(postings, key=len)
+
+
+def like_pattern(filter):
+    """
+    Translates an SQL LIKE pattern with the default backslash escape into a
+    case insensitive regular expression, returns it with the longest
+    literal part folded for the trigram lookup
+    """
+    regex = []
+    literals = ['']
+    chars = iter(filter)
+    for c in chars:
+        if c in '%_':
+            regex.append('.*' if c == '%' else '.')
+            literals.append('')
+            continue
+        if c == '\\':
+            c = next(chars, c)
+        regex.append(re.escape(c))
+        literals[-1] += c
+    return re.compile(''.join(regex) + r'\Z', re.IGNORECASE | re.DOTALL), max(literals, key=len).casefold()
+
+
+user_cache = None
+
+
+def parse_groups(groups):
+    """
+    Converts the comma separated groups column into a tuple of group names,
+    reusing the precomputed tuple from the user cache whenever possible
+    """
+    cache = user_cache
+    if cache is not None:
+        cached = cache.groups(groups)
+        if cached is not None:
+            return cached
+    return tuple(groups.split(',')) if groups else ()
+
+
+def refresh_user_cache(generation):
+    """
+    Loads all registered users into a fresh cache and swaps it in, every
+    [usercache] refresh seconds until restart_user_cache starts a new
+    generation
+    """
+    global user_cache
+    try:
+        sql = 'SELECT `user_id`, `username`, `display_name`, `groups` ' \
+              'FROM %smumble_mumbleuser ORDER BY `user_id`' % cfg.database.prefix
+        cur = threadDB.read(sql)
+        try:
+            cache = userCache(cur)
+        finally:
+            cur.close()
+        if generation == user_cache_generation:
+            # Not from a refresh that a restart, maybe disabling the cache, overtook
+            user_cache = cache
+        debug('User cache refreshed with %d users and %d groups', len(cache), len(cache.group_names))
+    except threadDbException:
+        warning('Could not refresh user cache, keeping the previous one')
+    threadDB.release()
+
+    global user_cache_timer
+    if generation == user_cache_generation:
+        user_cache_timer = Timer(cfg.usercache.refresh, refresh_user_cache, (generation,))
+        user_cache_timer.daemon = True
+        user_cache_timer.start()
+
+
+user_cache_timer = None
+# A refresh running during a restart sees the new generation and does not reschedule
+user_cache_generation = 0
+
+
+def restart_user_cache():
+    global user_cache, user_cache_generation
+    user_cache_generation += 1
+    if user_cache_timer is not None:
+        user_cache_timer.cancel()
+    if cfg.usercache.enabled:
+        refresh_user_cache(user_cache_generation)
+    else:
+        user_cache = None
+
+
+# Main character id of connected users by AllianceAuth user id, None for users
+# without a main character. Entries are dropped at login and disconnect, so a
+# changed main is picked up with the next login of its user.
+main_characters = {}
+
+
+def load_main_characters(user_ids):
+    """
+    Looks up the main character ids of the given users with one query per
+    500 users
+    """
+    user_ids = list(user_ids)
+    characters = dict((uid, None) for uid in user_ids)
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
+        sql = 'SELECT aup.user_id, eec.character_id ' \
+              'FROM %sauthentication_userprofile AS `aup` ' \
+              'JOIN %seveonline_evecharacter AS `eec` ON aup.main_character_id = eec.id ' \
+              'WHERE aup.user_id IN (%s)' % (cfg.database.prefix, cfg.database.prefix,
+                                             ', '.join(['%s'] * len(chunk)))
+        cur = threadDB.read(sql, chunk)
+        try:
+            characters.update((uid, charid) for uid, charid in cur)
+        finally:
+            cur.close()
+    return characters
+
+
+def refresh_main_characters(user_ids):
+    """
+    Bulk loads the main characters of the given, connected, users into
+    the main character map
+    """
+    characters = load_main_characters(user_ids)
+    main_characters.update(characters)
+    debug('Main characters loaded for %d connected users', len(characters))
+
+
+def avatar_url(character_id):
+    return cfg.user.ccp_avatar_url.replace('{charid}', str(character_id))
+
+
+# Bytes downloaded from the image server and bytes cached after transcoding
+texture_bytes = {'downloaded': 0, 'cached': 0}
+texture_bytes_lock = threading.Lock()
+
+
+def transcode_texture(data):
+    """
+    Decodes an avatar, scales it down to the configured texture size and
+    re-encodes it. Returns the original bytes if that fails or does not
+    make them smaller.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail((cfg.texture.size, cfg.texture.size), Image.LANCZOS)
+        if cfg.texture.format.upper() in ('JPEG', 'JPG') and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        image.save(out, cfg.texture.format, quality=cfg.texture.quality, optimize=True)
+    except (OSError, ValueError, KeyError, Image.DecompressionBombError) as e:
+        debug('Could not transcode texture, passing it on as is: %s', str(e))
+        return data
+    processed = out.getvalue()
+    if len(processed) >= len(data):
+        return data
+    return processed
+
+
+def download_texture(url):
+    """
+    Downloads an avatar and transcodes it if configured, returns the bytes
+    to cache
+    """
+    with span('texture download'):
+        handle = urlopen(url)
+        data = handle.read()
+        handle.close()
+
+    with texture_bytes_lock:
+        texture_bytes['downloaded'] += len(data)
+    if cfg.texture.transcode and Image is not None:
+        with span('texture transcode'):
+            processed = transcode_texture(data)
+        debug('Transcoded avatar "%s" from %d to %d bytes', url, len(data), len(processed))
+        data = processed
+    with texture_bytes_lock:
+        texture_bytes['cached'] += len(data)
+    return data
+
+
+# Outcome of the warm-up before attaching to Murmur
+warmup_report = {}
+
+
+def warm_up(user_ids, texture_cache, deadline):
+    """
+    Gets ready for the logins Murmur sends right after we attached: loads
+    the hash backend and the data of the users already connected, given
+    by their AllianceAuth ids, opens the minimum database pool and with
+    [warmup] avatars fetches their avatars into texture_cache. Stops at
+    the monotonic deadline.
+    """
+    start = time.monotonic()
+    report = warmup_report
+    report.clear()
+    report.update({'finished': False, 'users': len(user_ids)})
+
+    try:
+        # Loads the bcrypt library and runs passlib's backend self tests
+        bcrypt_sha256.get_backend()
+    except Exception as e:
+        warning('Warm-up could not load the bcrypt backend: %s', str(e))
+
+    try:
+        # Past the deadline attaching went ahead and started the cache refresh
+        # timer already, a restart from here would race it
+        if user_cache is not None and time.monotonic() < deadline and \
+                any(user_cache.position(uid) is None for uid in user_ids):
+            # Registered since the cache was loaded
+            restart_user_cache()
+        if cfg.user.avatar_enable and user_ids and time.monotonic() < deadline:
+            refresh_main_characters(user_ids)
+            report['characters'] = sum(1 for uid in user_ids if main_characters.get(uid) is not None)
+    except threadDbException:
+        warning('Warm-up could not load the connected users')
+    threadDB.release()
+
+    # The spares are for the Ice threads, this one is done with the database
+    try:
+        report['connections'] = threadDB.prefill(cfg.pool.db_min, deadline)
+    except threadDbException:
+        warning('Warm-up could not open database connections')
+
+    if cfg.warmup.avatars and cfg.user.avatar_enable:
+        report['avatars'] = 0
+        for uid in user_ids:
+            charid = main_characters.get(uid)
+            url = avatar_url(charid) if charid is not None else None
+            if not url or url in texture_cache:
+                continue
+            if time.monotonic() >= deadline:
+                break
+            try:
+                texture_cache[url] = download_texture(url)
+                report['avatars'] += 1
+            except Exception as e:
+                debug('Warm-up could not download avatar "%s": %s', url, str(e))
+
+    report['seconds'] = round(time.monotonic() - start, 2)
+    report['finished'] = True
+    info('Warm-up done in %.1fs: %s', report['seconds'],
+         ', '.join('%s %s' % (k, v) for k, v in sorted(report.items()) if k not in ('finished', 'seconds')))
+
+
+# Display name and groups handed to Murmur, pending ones by Murmur user id in
+# the order of authentication and by (virtual server id, session) once the
+# reconciler took over, with the groups the reconciler added to the session
+auth_grants = {}
+applied_grants = {}
+grants_lock = threading.Lock()
+
+
+def add_grant(user_id, display_name, groups):
+    with grants_lock:
+        auth_grants.setdefault(user_id, []).append((time.time(), display_name, groups))
+
+
+def take_grant(user_id):
+    """
+    Returns the oldest pending grant of the user or None, sessions of the
+    same user take them in the order they connected
+    """
+    with grants_lock:
+        grants = auth_grants.get(user_id)
+        if not grants:
+            return None
+        grant = grants.pop(0)
+        if not grants:
+            del auth_grants[user_id]
+        return grant
+
+
+def expire_grants(max_age):
+    """
+    Drops pending grants older than max_age seconds, left by logins that
+    never became a session
+    """
+    cutoff = time.time() - max_age
+    with grants_lock:
+        for user_id in list(auth_grants):
+            grants = [grant for grant in auth_grants[user_id] if grant[0] >= cutoff]
+            if grants:
+                auth_grants[user_id] = grants
+            else:
+                del auth_grants[user_id]
+
+
+def reconcile_sessions(server, sid):
+    """
+    Pushes group and display name changes from the user cache to users already
+    connected to a virtual server, only touching the sessions that changed.
+    sid is the label of the virtual server, unique across Meta endpoints.
+    """
+    cache = user_cache
+    if cache is None:
+        return
+    seen = set()
+    # Earlier sessions first, they take the earlier grants of their user
+    for user in sorted(server.getUsers().values(), key=lambda user: user.session):
+        if user.userid < cfg.user.id_offset:
+            continue
+        key = (sid, user.session)
+        seen.add(key)
+        record = cache.get(user.userid - cfg.user.id_offset)
+        if record is None:
+            continue
+        display_name = entity_decode(record[1])
+        groups = record[2]
+
+        current = applied_grants.get(key)
+        if current is None:
+            grant = take_grant(user.userid)
+            if grant is not None:
+                granted_at, current = grant[0], grant[1:] + (frozenset(),)
+                if granted_at > cache.loaded_at:
+                    # Authenticated with fresher data than the cache holds
+                    applied_grants[key] = current
+                    continue
+
+        if current is None:
+            # Authenticated before we started, all groups may be from the login
+            old_groups, added = (), frozenset()
+        else:
+            old_groups, added = current[1], current[2]
+
+        new = set(groups).difference(old_groups)
+        removed = set(old_groups).difference(groups)
+        try:
+            if removed.difference(added):
+                # Murmur keeps the groups returned by authenticate by user id,
+                # removeUserFromGroup only undoes addUserToGroup for a session.
+                # Only a new login drops them.
+                server.kickUser(user.session, 'Your groups changed, please reconnect')
+                info('Reconciler: Disconnected "%s" (%d) on virtual server %s to remove groups %s',
+                     display_name, user.userid, sid, ', '.join(sorted(removed)))
+                applied_grants.pop(key, None)
+                continue
+
+            for group in new:
+                server.addUserToGroup(0, user.session, group)
+            for group in removed:
+                server.removeUserFromGroup(0, user.session, group)
+            added = added.union(new).difference(removed)
+            if new or removed:
+                info('Reconciler: Updated groups of "%s" (%d) on virtual server %s',
+                     display_name, user.userid, sid)
+
+            if user.name != display_name:
+                info('Reconciler: Renamed "%s" to "%s" (%d) on virtual server %s',
+                     user.name, display_name, user.userid, sid)
+                user.name = display_name
+                server.setState(user)
+        except Ice.UserException as e:
+            # Most likely the user disconnected in the meantime
+            debug('Reconciler: Could not update session %d: %s', user.session, str(e))
+            continue
+
+        applied_grants[key] = (display_name, groups, added)
+
+    for key in [k for k in applied_grants if k[0] == sid and k not in seen]:
+        del applied_grants[key]
+
+
+class metaEndpoint(object):
+    """
+    A Murmur Meta server the authenticator serves. Besides the [ice] and
+    [murmur] sections every [meta:<name>] section configures one more.
+    """
+
+    def __init__(self, name, host, port, secret, servers):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.servers = servers
+        self.meta = None
+        self.metacb = None
+        self.auth = None
+        self.servercb = None
+        self.connected = False
+        self.failedWatch = True
+        self.watchdog = None
+        self.reconnector = None
+        self.reconnecting = False
+        self.lost_at = None
+        self.reattaches = 0
+        self.last_reattach = None
+        self.stopped_at = {}
+
+    def lost(self):
+        """
+        Marks the endpoint disconnected, the outage counts from the first loss
+        """
+        self.connected = False
+        if self.lost_at is None:
+            self.lost_at = time.monotonic()
+
+    def attached(self):
+        """
+        Marks the endpoint connected, returns the seconds it took to reattach
+        after a loss or None
+        """
+        self.connected = True
+        if self.lost_at is None:
+            return None
+        self.last_reattach = time.monotonic() - self.lost_at
+        self.lost_at = None
+        self.reattaches += 1
+        return self.last_reattach
+
+    def context(self, proxy):
+        """
+        Returns the proxy carrying this endpoint's secret, the shared implicit
+        context only holds the secret from [ice]
+        """
+        if self.secret and self.secret != cfg.ice.secret:
+            return proxy.ice_context({'secret': self.secret})
+        return proxy
+
+    def serves(self, sid, assignment=None):
+        """
+        Whether we authenticate for the virtual server, under the given
+        (position, count) worker assignment or the current one
+        """
+        if self.servers and sid not in self.servers:
+            return False
+        if assignment is None:
+            if worker_shard is None:
+                return True
+            assignment = worker_shard.assignment
+        position, count = assignment
+        return self.shard_key(sid) % count == position
+
+    def shard_key(self, sid):
+        # Deal out listed servers round robin in their configured order
+        return self.servers.index(sid) if self.servers else sid
+
+    def label(self, sid):
+        if self.name == 'default':
+            return str(sid)
+        return '%s/%d' % (self.name, sid)
+
+    def booted_servers(self):
+        """
+        Returns (id, proxy) of the booted virtual servers we authenticate for
+        """
+        servers = []
+        for server in self.meta.getBootedServers():
+            server = self.context(server)
+            sid = server.id()
+            if self.serves(sid):
+                servers.append((sid, server))
+        return servers
+
+
+class workerShard(object):
+    """
+    The share of the virtual servers a worker process authenticates for
+    when running under the supervisor. The supervisor sends a new
+    assignment over the pipe whenever it rebalances.
+    """
+
+    def __init__(self, slot, assignment, pipe):
+        self.slot = slot
+        self.assignment = assignment
+        self.pipe = pipe
+
+    def listen(self, callback):
+        """
+        Applies new assignments, callback is called with the previous one
+        """
+        def loop():
+            with os.fdopen(self.pipe, 'r') as pipe:
+                for line in pipe:
+                    previous, self.assignment = self.assignment, tuple(map(int, line.split()))
+                    if self.assignment == previous:
+                        continue
+                    info('Worker %d now serves share %d of %d', self.slot, self.assignment[0] + 1,
+                         self.assignment[1])
+                    try:
+                        callback(previous)
+                    except Exception as e:
+                        exception(e)
+            warning('Lost the connection to the supervisor, keeping the current assignment')
+
+        threading.Thread(target=loop, name='ShardListener', daemon=True).start()
+
+
+worker_shard = None
+
+
+def admin_socket(slot=None):
+    """
+    Path of the admin socket, every worker process listens on one of its own
+    """
+    if slot is None:
+        return cfg.admin.socket
+    return '%s.%d' % (cfg.admin.socket, slot)
+
+
+def load_endpoints():
+    endpoints = [metaEndpoint('default', cfg.ice.host, cfg.ice.port, cfg.ice.secret, cfg.murmur.servers)]
+    for name, section in sorted(cfg.meta.items()):
+        endpoints.append(metaEndpoint(name, section.host, section.port, section.secret, section.servers))
+    return endpoints
+
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+class healthMonitor(object):
+    """
+    Periodically checks the Ice connection, the database and a canary login
+    on every authenticated virtual server and serves the last result as JSON
+    over HTTP, so probes do not need to start an Ice client of their own
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.result = {'status': 'starting', 'components': {}}
+        self.checked = time.monotonic()
+        self.stopped = threading.Event()
+        self.httpd = None
+        # A single long lived thread so the database connection is reused, a
+        # hanging query only blocks it and not the monitor
+        self.database = concurrent.futures.ThreadPoolExecutor(1, 'HealthDatabase')
+
+    def start(self):
+        # Worker processes listen on consecutive ports
+        port = cfg.health.port + (worker_shard.slot if worker_shard is not None else 0)
+        self.httpd = ThreadingHTTPServer((cfg.health.host, port), healthRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.monitor = self
+        threading.Thread(target=self.httpd.serve_forever, name='HealthServer', daemon=True).start()
+        threading.Thread(target=self.loop, name='HealthMonitor', daemon=True).start()
+        info('Serving health status on http://%s:%d/health', cfg.health.host, port)
+
+    def stop(self):
+        self.stopped.set()
+        self.database.submit(threadDB.release)
+        self.database.shutdown(wait=False)
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def loop(self):
+        while not self.stopped.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                exception(e)
+            self.stopped.wait(cfg.health.interval)
+
+    def stale(self):
+        """
+        Whether the last result is older than a check should ever take, the
+        monitor is stuck and the result can not be trusted anymore
+        """
+        return time.monotonic() - self.checked > cfg.health.interval + cfg.health.timeout
+
+    def check(self):
+        deadline = time.monotonic() + cfg.health.timeout
+        components = {'ice': self.check_ice(deadline), 'database': self.check_database(deadline)}
+        servers = components['ice'].pop('servers', [])
+        components['servers'] = self.check_servers(servers, deadline)
+        if query_plans:
+            # Only reported, missing indexes make us slow but not unhealthy
+            components['query_plans'] = query_plans
+
+        ok = components['ice']['ok'] and components['database']['ok'] and \
+            all(server['ok'] for server in components['servers'].values())
+        self.result = {'status': 'ok' if ok else 'failure',
+                       'checked_at': datetime.datetime.now().isoformat(),
+                       'components': components}
+        self.checked = time.monotonic()
+        if not ok:
+            warning('Health check failed: %s', json.dumps(components))
+
+    def check_ice(self, deadline):
+        result = {'ok': True, 'latency_ms': 0, 'endpoints': {}, 'servers': []}
+        calls = [(endpoint, time.perf_counter(), endpoint.meta.getBootedServersAsync())
+                 for endpoint in self.app.endpoints]
+        for endpoint, start, future in calls:
+            try:
+                servers = future.result(max(0, deadline - time.monotonic()))
+            except Ice.Exception as e:
+                result['ok'] = False
+                result['endpoints'][endpoint.name] = {'ok': False, 'latency_ms': elapsed_ms(start),
+                                                      'error': str(e) or e.__class__.__name__}
+                continue
+            latency = elapsed_ms(start)
+            result['latency_ms'] = max(result['latency_ms'], latency)
+            result['endpoints'][endpoint.name] = {'ok': True, 'latency_ms': latency}
+            result['servers'].extend((endpoint, endpoint.context(server)) for server in servers)
+        return result
+
+    def check_database(self, deadline):
+        start = time.perf_counter()
+
+        def select():
+            cur = threadDB.execute('SELECT 1')
+            cur.fetchone()
+            cur.close()
+
+        error_msg = None
+        try:
+            # Queued behind a query that still hangs from an earlier check
+            self.database.submit(select).result(max(0, deadline - time.monotonic()))
+            ok = True
+        except threadDbException:
+            ok = False
+        except concurrent.futures.TimeoutError:
+            ok, error_msg = False, 'timeout'
+        result = {'ok': ok,
+                  'latency_ms': elapsed_ms(start),
+                  'breaker': threadDB.primary.breaker.state}
+        if error_msg:
+            result['error'] = error_msg
+        if threadDB.replicas:
+            result['replicas'] = dict((r.name, {'healthy': r.healthy, 'lag': r.lag, 'breaker': r.breaker.state})
+                                      for r in threadDB.replicas)
+        return result
+
+    def check_servers(self, servers, deadline):
+        """
+        Runs the canary verifyPassword against all authenticated virtual servers
+        concurrently, bounded by the overall deadline
+        """
+        ids = [(endpoint, server, server.idAsync()) for endpoint, server in servers]
+        calls = []
+        for endpoint, server, future in ids:
+            try:
+                sid = future.result(max(0, deadline - time.monotonic()))
+            except Ice.Exception:
+                continue
+            if endpoint.serves(sid):
+                start = time.perf_counter()
+                future = server.verifyPasswordAsync(cfg.healthcheck.username, cfg.healthcheck.password)
+                # Take the latency when the reply arrives, not when we get around to look at it
+                latency = {}
+                future.add_done_callback(lambda f, start=start, latency=latency:
+                                         latency.setdefault('ms', elapsed_ms(start)))
+                calls.append((endpoint.label(sid), start, future, latency))
+
+        results = {}
+        for label, start, future, latency in calls:
+            try:
+                ret = future.result(max(0, deadline - time.monotonic()))
+                error_msg = None
+            except Ice.Exception as e:
+                ret = None
+                error_msg = str(e) or e.__class__.__name__
+            # -2 means the canary user is unknown, -1 only matters if we know the password
+            ok = ret is not None and ret != -2 and not (cfg.healthcheck.password and ret == -1)
+            results[label] = {'ok': ok, 'ret': ret, 'latency_ms': latency.get('ms', elapsed_ms(start))}
+            if error_msg:
+                results[label]['error'] = error_msg
+        return results
 
 
-#
-# --- Helper classes
-#
-class config(object):
+class healthRequestHandler(BaseHTTPRequestHandler):
     """
-    Small abstraction for config loading
+    Serves the cached health check result
     """
 
-    def __init__(self, filename=None, default=None):
-        if not filename or not default:
+    def do_GET(self):
+        if self.path.split('?')[0].rstrip('/') not in ('', '/health'):
+            self.send_error(404)
             return
-        cfg = configparser.ConfigParser()
-        cfg.optionxform = str
-        cfg.read(filename)
+        monitor = self.server.monitor
+        result = monitor.result
+        if result['status'] == 'ok' and monitor.stale():
+            result = dict(result, status='stale')
+        body = json.dumps(result).encode()
+        self.send_response(200 if result['status'] == 'ok' else 503)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        debug('Health request: ' + format, *args)
+
+
+class rateLimitFilter(logging.Filter):
+    """
+    Lets at most `burst` records with the same message template through per
+    `window` seconds, so a repeating error can not flood the log
+    """
 
-        for h, v in default.items():
-            if not v:
-                # Output this whole section as a list of raw key/value tuples
-                try:
-                    self.__dict__[h] = cfg.items(h)
-                except configparser.NoSectionError:
-                    self.__dict__[h] = []
-            else:
-                self.__dict__[h] = config()
-                for name, conv, vdefault in v:
-                    try:
-                        self.__dict__[h].__dict__[name] = conv(cfg.get(h, name))
-                    except (ValueError, configparser.NoSectionError, configparser.NoOptionError):
-                        self.__dict__[h].__dict__[name] = vdefault
+    def __init__(self, burst, window):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.window = window
+        self.counters = {}
+        self.pruned = time.monotonic()
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.CRITICAL:
+            return True
+        # msg can be an exception object, only its text is a template
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            if now - self.pruned >= self.window:
+                self.prune(now)
+            start, count, suppressed = self.counters.get(key, (now, 0, 0))
+            if now - start >= self.window:
+                start, count = now, 0
+            if count >= self.burst:
+                self.counters[key] = (start, count, suppressed + 1)
+                return False
+            self.counters[key] = (start, count + 1, 0)
+        if suppressed:
+            record.msg = '%s (%d similar messages suppressed)' % (record.getMessage(), suppressed)
+            record.args = None
+        return True
 
+    def prune(self, now):
+        """
+        Forgets the counters of windows that ended, one-off messages would
+        pile up otherwise. Counters with suppressed messages are kept one
+        more window so the next message can still report them.
+        """
+        self.counters = dict((key, counter) for key, counter in self.counters.items()
+                             if now - counter[0] < self.window * (2 if counter[2] else 1))
+        self.pruned = now
 
-def entity_decode(string):
+
+class droppingQueueHandler(QueueHandler):
     """
-    Python reverse implementation of php htmlspecialchars
+    Queue handler that drops records instead of blocking or raising when the
+    background writer can not keep up
     """
-    htmlspecialchars = (('"', '&quot;'),
-                        ("'", '&#039;'),
-                        ('<', '&lt;'),
-                        ('>', '&gt'),
-                        ('&', '&amp;'))
-    ret = string
-    for (s, t) in htmlspecialchars:
-        ret = ret.replace(t, s)
-    return ret
 
+    dropped = 0
 
-def entity_encode(string):
+    def prepare(self, record):
+        # The queue never leaves the process, so formatting is left to the writer thread.
+        # The message is merged here as its arguments may change before it is written.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+log_listener = None
+
+
+def start_async_logging():
     """
-    Python implementation of htmlspecialchars
+    Moves all root log handlers behind a queue served by a background thread,
+    so file and stderr I/O never happens on Ice dispatch threads.
+    Has to run after daemonizing as the writer thread would not survive the fork.
     """
-    htmlspecialchars = (('&', '&amp;'),
-                        ('"', '&quot;'),
-                        ("'", '&#039;'),
-                        ('<', '&lt;'),
-                        ('>', '&gt'))
-    ret = string
-    for (s, t) in htmlspecialchars:
-        ret = ret.replace(s, t)
-    return ret
+    global log_listener
+    root = getLogger()
+    handlers = root.handlers[:]
+    handler = droppingQueueHandler(queue.Queue(cfg.log.queue_size))
+    for h in handlers:
+        root.removeHandler(h)
+        # Filters run on the dispatch thread, before the record is queued
+        for f in h.filters[:]:
+            handler.addFilter(f)
+            h.removeFilter(f)
+    root.addHandler(handler)
+    log_listener = QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+
+def stop_async_logging():
+    global log_listener
+    stop_slow_log()
+    if log_listener:
+        log_listener.stop()
+        log_listener = None
+
+
+def dump_stacks():
+    """
+    Returns the current stack of every thread
+    """
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    out = []
+    for tid, frame in sys._current_frames().items():
+        out.append('Thread %s (%d):\n%s' % (names.get(tid, '?'), tid, ''.join(traceback.format_stack(frame))))
+    return '\n'.join(out)
 
 
-class threadDbException(Exception):
-    pass
+def sample_profile(seconds, interval=0.005):
+    """
+    Statistical profiler, samples the stacks of all other threads every
+    interval seconds and returns the sample counts per collapsed stack
+    """
+    own = thread.get_ident()
+    stacks = {}
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for tid, frame in sys._current_frames().items():
+            if tid == own:
+                continue
+            calls = []
+            while frame is not None:
+                calls.append('%s:%s' % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                frame = frame.f_back
+            key = ';'.join(reversed(calls))
+            stacks[key] = stacks.get(key, 0) + 1
+        time.sleep(interval)
+    return stacks
+
+
+def state_snapshot(app):
+    """
+    Collects the state of caches, database connections and background jobs
+    """
+    cache = user_cache
+    state = {
+        'threads': sorted(t.name for t in threading.enumerate()),
+        'user_cache': None if cache is None else {
+            'users': len(cache),
+            'groups': len(cache.group_names),
+            'group_sets': len(cache.sets),
+            'age_seconds': round(time.time() - cache.loaded_at),
+        },
+        'database': {
+            'connections': sorted('%s/%d' % (name, tid) for tid, name in list(threadDB.db_connections)),
+            'spares': sum(len(spares) for spares in list(threadDB.spare_connections.values())),
+            'hosts': dict((h.name, {'healthy': h.healthy, 'lag': h.lag, 'breaker': h.breaker.state,
+                                    'failures': h.breaker.failures})
+                          for h in [threadDB.primary] + threadDB.replicas if h is not None),
+        },
+        'reconciler': {'auth_grants': sum(len(grants) for grants in list(auth_grants.values())),
+                       'sessions': len(applied_grants)},
+        'admission': dict((name, c.stats()) for name, c in admission_classes.items()),
+        'pool': pool_controller.report if pool_controller is not None else None,
+        'warmup': warmup_report,
+        'jobs': {},
+    }
+    if worker_shard is not None:
+        state['worker'] = {'slot': worker_shard.slot, 'pid': os.getpid(),
+                           'position': worker_shard.assignment[0], 'count': worker_shard.assignment[1]}
+    authenticator = getattr(app, 'authenticator', None)
+    if authenticator is not None:
+        textures = list(authenticator.texture_cache.values())
+        state['texture_cache'] = {'entries': len(textures), 'bytes': sum(len(t) for t in textures),
+                                  'bytes_saved': texture_bytes['downloaded'] - texture_bytes['cached'],
+                                  'main_characters': len(main_characters)}
+    for job in ('idler', 'reconciler'):
+        timer = getattr(app, job, None)
+        if timer is not None:
+            state['jobs'][job] = 'scheduled' if timer.is_alive() else 'stopped'
+    for endpoint in getattr(app, 'endpoints', []):
+        state['jobs']['watchdog %s' % endpoint.name] = {
+            'connected': endpoint.connected,
+            'timer': 'scheduled' if endpoint.watchdog is not None and endpoint.watchdog.is_alive() else 'stopped',
+            'reconnecting': endpoint.reconnecting,
+            'reattaches': endpoint.reattaches,
+            'last_reattach_s': None if endpoint.last_reattach is None else round(endpoint.last_reattach, 2),
+        }
+    health = getattr(app, 'health', None)
+    if health is not None:
+        state['health'] = health.result
+    handler = next((h for h in getLogger().handlers if isinstance(h, droppingQueueHandler)), None)
+    if handler is not None:
+        state['log_queue'] = {'pending': handler.queue.qsize(), 'dropped': handler.dropped}
+    return state
+
+
+class adminRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handles one command per connection on the admin socket:
 
+        stacks                  dump the stacks of all threads
+        profile <seconds>       run the sampling profiler and write the result to disk
+        state                   snapshot of caches, database and background jobs as JSON
+        reload                  reload the configuration file
+    """
 
-class threadDB(object):
+    def handle(self):
+        line = self.rfile.readline().decode('utf-8', 'replace').split()
+        if not line:
+            return
+        command, args = line[0], line[1:]
+        info('Admin command: %s', ' '.join(line))
+        try:
+            handler = getattr(self, 'do_' + command, None)
+            if handler is None:
+                reply = inspect.cleandoc(adminRequestHandler.__doc__) + '\n'
+            else:
+                reply = handler(*args)
+        except Exception as e:
+            exception(e)
+            reply = 'Error: %s\n' % str(e)
+        self.wfile.write(reply.encode('utf-8'))
+
+    def do_stacks(self):
+        return dump_stacks()
+
+    def do_profile(self, seconds='10'):
+        seconds = min(float(seconds), 600)
+        stacks = sample_profile(seconds, cfg.admin.profile_interval)
+        path = os.path.join(cfg.admin.profile_dir,
+                            'profile-%s.txt' % datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+        with open(path, 'w') as f:
+            # Collapsed stack format as understood by flamegraph tools
+            for stack, count in sorted(stacks.items(), key=lambda x: -x[1]):
+                f.write('%s %d\n' % (stack, count))
+        leaves = {}
+        for stack, count in stacks.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        total = sum(leaves.values()) or 1
+        top = sorted(leaves.items(), key=lambda x: -x[1])[:15]
+        return 'Profile of %.1fs written to %s\n%s\n' % (
+            seconds, path, '\n'.join('%5.1f%% %s' % (100.0 * c / total, leaf) for leaf, c in top))
+
+    def do_state(self):
+        return json.dumps(state_snapshot(self.server.app), indent=2) + '\n'
+
+    def do_reload(self):
+        if self.server.app.reload():
+            return 'Configuration reloaded\n'
+        return 'Reload failed, see the log\n'
+
+
+class adminServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
     """
-    Small abstraction to handle database connections for multiple
-    threads
+    Local control socket to inspect the running authenticator
     """
 
-    db_connections = {}
+    daemon_threads = True
 
-    def connection(cls):
-        tid = thread.get_ident()
-        try:
-            con = cls.db_connections[tid]
-        except:
-            info('Connecting to database server (%s %s:%d %s) for thread %d',
-                 cfg.database.lib,
-                 cfg.database.host,
-                 cfg.database.port,
-                 cfg.database.name,
-                 tid)
+    def __init__(self, app):
+        self.app = app
+        self.path = admin_socket(worker_shard.slot if worker_shard is not None else None)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        socketserver.UnixStreamServer.__init__(self, self.path, adminRequestHandler)
+        # Only the user running the authenticator may talk to it
+        os.chmod(self.path, 0o600)
 
-            try:
-                con = db.connect(host=cfg.database.host,
-                                 port=cfg.database.port,
-                                 user=cfg.database.user,
-                                 passwd=cfg.database.password,
-                                 db=cfg.database.name,
-                                 charset='utf8')
-                # Transactional engines like InnoDB initiate a transaction even
-                # on SELECTs-only.
-                # Thus, we auto-commit so Authenticator gets recent data.
-
-                con.autocommit(True)
-            except db.Error as e:
-                error('Could not connect to database: %s', str(e))
-                raise threadDbException()
-            cls.db_connections[tid] = con
-        return con
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='AdminServer', daemon=True).start()
+        info('Admin socket listening on %s', self.path)
 
-    connection = classmethod(connection)
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
 
-    def cursor(cls):
-        return cls.connection().cursor()
 
-    cursor = classmethod(cursor)
+def admin_command(path, command):
+    """
+    Sends a command to the admin socket of a running authenticator and
+    returns its reply
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(command.encode('utf-8') + b'\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return b''.join(chunks).decode('utf-8')
+
+
+class workerSupervisor(object):
+    """
+    Forks worker processes that each authenticate for a disjoint share of
+    the virtual servers. Crashed workers are restarted, until they come
+    back their servers are handed to the remaining workers.
+    """
 
-    def execute(cls, *args, **kwargs):
-        if "threadDB__retry_execution__" in kwargs:
-            # Have a magic keyword so we can call ourselves while preventing
-            # an infinite loop
-            del kwargs["threadDB__retry_execution__"]
-            retry = False
-        else:
-            retry = True
+    def __init__(self, count):
+        self.count = count
+        self.workers = {}
+        self.pending = {}
+        self.restarts = {}
+        self.stopping = False
+        self.deadline = None
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.forward)
+        signal.signal(signal.SIGUSR1, self.forward)
+
+        info('Supervisor starting %d workers', self.count)
+        for slot in range(self.count):
+            self.spawn(slot, range(self.count))
+
+        while self.workers or (self.pending and not self.stopping):
+            self.reap()
+            now = time.monotonic()
+            if self.stopping:
+                if now > self.deadline:
+                    warning('Workers did not stop within %ds, killing them', cfg.workers.stop_timeout)
+                    self.signal(signal.SIGKILL)
+                    self.deadline = float('inf')
+            else:
+                for slot, when in sorted(self.pending.items()):
+                    if when <= now:
+                        del self.pending[slot]
+                        self.spawn(slot, list(self.workers) + [slot])
+                        self.assign()
+            time.sleep(0.2)
+
+        if self.stopping:
+            info('All workers stopped')
+            return 0
+        error('No workers left, giving up')
+        return 1
 
-        c = cls.cursor()
-        try:
-            c.execute(*args, **kwargs)
-        except db.OperationalError as e:
-            error('Database operational error %d: %s', e.args[0], e.args[1])
-            c.close()
-            cls.invalidate_connection()
-            if retry:
-                # Make sure we only retry once
-                info('Retrying database operation')
-                kwargs["threadDB__retry_execution__"] = True
-                c = cls.execute(*args, **kwargs)
+    def spawn(self, slot, live):
+        """
+        Forks the worker for slot, live are the slots sharing the servers
+        """
+        global worker_shard
+        live = sorted(live)
+        reader, writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(writer)
+            for _, fd in self.workers.values():
+                os.close(fd)
+            for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+                signal.signal(sig, signal.SIG_DFL)
+            worker_shard = workerShard(slot, (live.index(slot), len(live)), reader)
+            code = 1
+            try:
+                code = do_main_program() or 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException as e:
+                exception(e)
+            finally:
+                logging.shutdown()
+                os._exit(code)
+
+        os.close(reader)
+        self.workers[slot] = (pid, writer)
+        info('Started worker %d (pid %d) serving share %d of %d', slot, pid, live.index(slot) + 1, len(live))
+
+    def assign(self):
+        """
+        Sends every running worker its share of the servers
+        """
+        live = sorted(self.workers)
+        for position, slot in enumerate(live):
+            try:
+                os.write(self.workers[slot][1], ('%d %d\n' % (position, len(live))).encode())
+            except OSError:
+                pass  # Died meanwhile, reap() takes care of it
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot = next((s for s, (p, _) in self.workers.items() if p == pid), None)
+            if slot is None:
+                continue
+            os.close(self.workers.pop(slot)[1])
+            if self.stopping:
+                info('Worker %d stopped', slot)
+                continue
+
+            if os.WIFSIGNALED(status):
+                reason = 'signal %d' % os.WTERMSIG(status)
             else:
-                error('Database operation failed ultimately')
-                raise threadDbException()
-        return c
+                reason = 'exit code %d' % os.WEXITSTATUS(status)
+            warning('Worker %d (pid %d) died with %s, handing its servers to the remaining workers',
+                    slot, pid, reason)
+            self.assign()
+
+            now = time.monotonic()
+            restarts = [t for t in self.restarts.get(slot, []) if now - t < cfg.workers.restart_window]
+            self.restarts[slot] = restarts + [now]
+            if len(restarts) >= cfg.workers.max_restarts:
+                error('Worker %d failed %d times within %ds, not restarting it',
+                      slot, len(restarts) + 1, cfg.workers.restart_window)
+            else:
+                self.pending[slot] = now + cfg.workers.restart_delay
 
-    execute = classmethod(execute)
+    def signal(self, sig):
+        for pid, _ in self.workers.values():
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
 
-    def invalidate_connection(cls):
-        tid = thread.get_ident()
-        con = cls.db_connections.pop(tid, None)
-        if con:
-            debug('Invalidate connection to database for thread %d', tid)
-            con.close()
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        info('Caught signal %d, stopping workers', signum)
+        self.stopping = True
+        self.deadline = time.monotonic() + cfg.workers.stop_timeout
+        self.signal(signal.SIGTERM)
 
-    invalidate_connection = classmethod(invalidate_connection)
+    def forward(self, signum, frame):
+        self.signal(signum)
 
-    def disconnect(cls):
-        while cls.db_connections:
-            tid, con = cls.db_connections.popitem()
-            debug('Close database connection for thread %d', tid)
-            con.close()
 
-    disconnect = classmethod(disconnect)
+def run_program():
+    """
+    Runs the authenticator, as supervisor of worker processes if configured
+    """
+    if cfg.workers.count > 1:
+        sys.exit(workerSupervisor(cfg.workers.count).run())
+    do_main_program()
 
 
 def do_main_program():
@@ -296,45 +3017,280 @@ def do_main_program():
     # --- Authenticator implementation
     #    All of this has to go in here so we can correctly daemonize the tool
     #    without loosing the file descriptors opened by the Ice module
-    slicedir = Ice.getSliceDir()
-    if not slicedir:
-        slicedir = ["-I/usr/share/Ice/slice", "-I/usr/share/slice"]
-    else:
-        slicedir = ['-I' + slicedir]
-    Ice.loadSlice('', slicedir + [cfg.ice.slice])
-    # ICE Slice module was changed from Murmur to MumbleServer in 1.5
-    try:
-        import Murmur
-        debug("Using pre-1.5 slice.")
-    except ImportError:
-        import MumbleServer as Murmur
-        debug("Using post-1.5 slice.")
+    if cfg.log.async_write:
+        start_async_logging()
+    if cfg.trace.enabled:
+        setup_slow_log()
+
+    Murmur = load_slice(cfg.ice.slice)
 
     class allianceauthauthenticatorApp(Ice.Application):
         def run(self, args):
-            self.shutdownOnInterrupt()
+            # SIGHUP reloads the configuration, everything else shuts down
+            self.callbackOnInterrupt()
+            self.interruptedBy = None
+            self.jobGeneration = 0
+            self.reconnectLock = threading.Lock()
+            # SIGHUP and the admin socket may ask for a reload at the same time
+            self.reloadLock = threading.Lock()
 
             if not self.initializeIceConnection():
                 return 1
 
             if cfg.ice.watchdog > 0:
-                self.failedWatch = True
-                self.checkConnection()
+                for endpoint in self.endpoints:
+                    endpoint.failedWatch = True
+                    self.checkConnection(endpoint)
+
+            self.startJobs()
+
+            if worker_shard is not None:
+                worker_shard.listen(self.rebalance)
+
+            if cfg.health.enabled:
+                self.health = healthMonitor(self)
+                self.health.start()
+
+            if cfg.admin.enabled:
+                self.admin = adminServer(self)
+                self.admin.start()
 
             # Serve till we are stopped
             self.communicator().waitForShutdown()
-            self.watchdog.cancel()
-
-            if self.interrupted():
+            for endpoint in self.endpoints:
+                for timer in (endpoint.watchdog, endpoint.reconnector):
+                    if timer is not None:
+                        timer.cancel()
+            self.stopJobs()
+            if getattr(self, 'health', None):
+                self.health.stop()
+            if getattr(self, 'admin', None):
+                self.admin.stop()
+
+            if self.interruptedBy is not None:
                 warning('Caught interrupt, shutting down')
 
             threadDB.disconnect()
             return 0
 
+        def interruptCallback(self, sig):
+            if sig == signal.SIGHUP:
+                self.reload()
+                return
+            self.interruptedBy = sig
+            if cfg.drain.enabled and not draining:
+                self.drain()
+            self.communicator().shutdown()
+
+        def drain(self):
+            """
+            Detaches from all virtual servers so Murmur falls back right away
+            instead of waiting out its timeout on us, then lets the calls in
+            flight finish and writes the deferred session updates, all
+            within the drain deadline
+            """
+            start = time.monotonic()
+            deadline = start + cfg.drain.deadline
+            info('Draining for shutdown, deadline %.1fs', cfg.drain.deadline)
+            stop_admission()
+            session_writes.defer()
+            for endpoint in self.endpoints:
+                for timer in (endpoint.watchdog, endpoint.reconnector):
+                    if timer is not None:
+                        timer.cancel()
+            self.stopJobs()
+
+            self.detachAll(deadline)
+
+            busy = dispatches.wait_idle(deadline)
+            if busy:
+                warning('%d calls still in flight at the drain deadline', busy)
+
+            def flush():
+                try:
+                    flushed = session_writes.flush()
+                    if flushed:
+                        info('Wrote %d deferred session updates', flushed)
+                except threadDbException:
+                    error('Could not write the deferred session updates')
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if session_writes.count():
+                    warning('No time left to write %d deferred session updates', session_writes.count())
+            else:
+                writer = threading.Thread(target=flush, name='drain flush', daemon=True)
+                writer.start()
+                writer.join(remaining)
+                if writer.is_alive():
+                    warning('Deferred session updates not written within the drain deadline')
+            info('Drained in %.1fs', time.monotonic() - start)
+
+        def detachAll(self, deadline):
+            """
+            Clears the authenticator and removes our callbacks from the
+            virtual servers of every endpoint, bounded by the deadline
+            """
+            calls = []
+            for endpoint in self.endpoints:
+                if not endpoint.connected:
+                    continue
+                calls.append((endpoint.name, endpoint.meta.removeCallbackAsync(endpoint.metacb)))
+                try:
+                    servers = endpoint.meta.getBootedServersAsync().result(max(0, deadline - time.monotonic()))
+                    servers = [endpoint.context(server) for server in servers]
+                    ids = [(server, server.idAsync()) for server in servers]
+                    # Servers of other workers keep their authenticator
+                    servers = [server for server, future in ids
+                               if endpoint.serves(future.result(max(0, deadline - time.monotonic())))]
+                except Ice.Exception as e:
+                    warning('Could not list virtual servers of %s to detach: %s', endpoint.name, str(e))
+                    continue
+                for server in servers:
+                    calls.append((endpoint.name, server.setAuthenticatorAsync(None)))
+                    calls.append((endpoint.name, server.removeCallbackAsync(endpoint.servercb)))
+
+            failed = 0
+            for name, future in calls:
+                try:
+                    future.result(max(0, deadline - time.monotonic()))
+                except Ice.Exception as e:
+                    failed += 1
+                    debug('Detaching from %s failed: %s', name, str(e) or e.__class__.__name__)
+            if failed:
+                warning('%d of %d detach calls failed or timed out', failed, len(calls))
+            else:
+                info('Detached from all virtual servers')
+
+        def startJobs(self):
+            """
+            Starts the periodic jobs enabled in the configuration
+            """
+            self.jobGeneration += 1
+            if cfg.idlerhandler.enabled:
+                self.idleSweep(self.jobGeneration)
+            if cfg.reconciler.enabled:
+                self.reconcileSessions(self.jobGeneration)
+
+        def stopJobs(self):
+            # Runs in progress see the new generation and do not reschedule
+            self.jobGeneration += 1
+            for job in ('idler', 'reconciler'):
+                timer = getattr(self, job, None)
+                if timer is not None:
+                    timer.cancel()
+
+        def reload(self):
+            """
+            Re-reads the configuration and rebuilds only the subsystems whose
+            settings changed. The Ice adapter, the registration with Murmur
+            and all caches stay as they are.
+            """
+            with self.reloadLock:
+                return self.reloadLocked()
+
+        def reloadLocked(self):
+            global cfg
+            info('Reloading configuration from %s', cfgfile)
+            try:
+                new = config(cfgfile, default)
+            except Exception as e:
+                error('Could not reload configuration, keeping the current one: %s', str(e))
+                return False
+
+            old = cfg
+            # Settings only read at startup keep their running values until
+            # the next restart, so the running state matches cfg
+            for section in ('ice', 'iceraw', 'glacier', 'trace', 'admin', 'meta', 'workers', 'warmup'):
+                if vars_of(old, section) != vars_of(new, section):
+                    warning('Changes to [%s] only take effect after a restart', section)
+                    new.__dict__[section] = old.__dict__[section]
+            for section, name in (('user', 'id_offset'), ('user', 'reject_on_error'),
+                                  ('pool', 'threads_min'), ('pool', 'threads_max'),
+                                  ('database', 'lib'), ('log', 'file'),
+                                  ('log', 'async_write'), ('log', 'queue_size')):
+                if getattr(old.__dict__[section], name) != getattr(new.__dict__[section], name):
+                    warning('Changes to [%s] %s only take effect after a restart', section, name)
+                    setattr(new.__dict__[section], name, getattr(old.__dict__[section], name))
+            changed = sorted(h.rstrip(':*') for h in default if vars_of(old, h) != vars_of(new, h))
+
+            self.stopJobs()
+            cfg = new
+            try:
+                if 'log' in changed:
+                    apply_log_config()
+                if 'database' in changed:
+                    threadDB.setup()
+                    restart_replica_checks()
+                    if cfg.database.explain:
+                        advise_indexes()
+                if 'usercache' in changed:
+                    restart_user_cache()
+                if 'admission' in changed:
+                    setup_admission()
+                if 'pool' in changed:
+                    restart_pool_controller()
+                if 'database' in changed:
+                    # Without the pool controller nothing else closes them
+                    sweep_stale_connections(cfg.pool.idle_timeout)
+                if 'murmur' in changed:
+                    endpoint = self.endpoints[0]
+                    previous, endpoint.servers = endpoint.servers, cfg.murmur.servers
+                    try:
+                        self.detachServers(endpoint, previous)
+                        self.attachCallbacks(endpoint)
+                    except Ice.Exception as e:
+                        warning('Could not apply the virtual server list to %s, leaving it to the watchdog: %s',
+                                endpoint.name, str(e) or e.__class__.__name__)
+                if 'health' in changed:
+                    if getattr(self, 'health', None):
+                        self.health.stop()
+                        self.health = None
+                    if cfg.health.enabled:
+                        self.health = healthMonitor(self)
+                        self.health.start()
+            finally:
+                # Whatever failed above, the periodic jobs must keep running
+                self.startJobs()
+
+            info('Configuration reloaded, changed sections: %s', ', '.join(changed) or 'none')
+            return True
+
+        def detachServers(self, endpoint, previous):
+            """
+            Removes the authenticator from virtual servers that were served
+            with the previous server list but no longer are
+            """
+            for server in endpoint.meta.getBootedServers():
+                server = endpoint.context(server)
+                sid = server.id()
+                if (not previous or sid in previous) and not endpoint.serves(sid):
+                    info('Removing authenticator from virtual server %s', endpoint.label(sid))
+                    server.setAuthenticator(None)
+                    server.removeCallback(endpoint.servercb)
+
+        def rebalance(self, previous):
+            """
+            Moves to the servers the supervisor assigned. Servers handed to
+            another worker only lose our callbacks, their new owner replaces
+            the authenticator so they are never left without one.
+            """
+            for endpoint in self.endpoints:
+                try:
+                    for server in endpoint.meta.getBootedServers():
+                        server = endpoint.context(server)
+                        sid = server.id()
+                        if endpoint.serves(sid, previous) and not endpoint.serves(sid):
+                            info('Handing virtual server %s to another worker', endpoint.label(sid))
+                            server.removeCallback(endpoint.servercb)
+                    self.attachCallbacks(endpoint)
+                except Ice.Exception as e:
+                    warning('Could not rebalance %s, leaving it to the watchdog: %s', endpoint.name, str(e))
+
         def initializeIceConnection(self):
             """
             Establishes the two-way Ice connection and adds the authenticator to the
-            configured servers
+            configured servers of every Meta endpoint
             """
             ice = self.communicator()
 
@@ -349,26 +3305,65 @@ def do_main_program():
                 error('Glacier support not implemented yet')
                 # TODO: Implement this
 
-            info('Connecting to Ice server (%s:%d)', cfg.ice.host, cfg.ice.port)
-            base = ice.stringToProxy('Meta:tcp -h %s -p %d' % (cfg.ice.host, cfg.ice.port))
-            self.meta = Murmur.MetaPrx.uncheckedCast(base)
-
             adapter = ice.createObjectAdapterWithEndpoints('Callback.Client',
                                                            'tcp -h %s' % cfg.ice.endpoint)
             adapter.activate()
 
-            metacbprx = adapter.addWithUUID(metaCallback(self))
-            self.metacb = Murmur.MetaCallbackPrx.uncheckedCast(metacbprx)
-
-            servercbprx = adapter.addWithUUID(serverCallback(self))
-            self.servercb = Murmur.ServerCallbackPrx.uncheckedCast(servercbprx)
-
-            authprx = adapter.addWithUUID(allianceauthauthenticator())
-            self.auth = Murmur.ServerUpdatingAuthenticatorPrx.uncheckedCast(authprx)
-
-            return self.attachCallbacks()
+            # The adapter, authenticator and server callback are shared by all endpoints,
+            # each endpoint reaches them under identities of its own for checkSecret
+            servercb = serverCallback(self)
+            self.authenticator = allianceauthauthenticator()
+
+            def addServant(servant, endpoint):
+                proxy = adapter.addWithUUID(servant)
+                servant_secrets[proxy.ice_getIdentity().name] = endpoint.secret
+                return proxy
+
+            self.endpoints = load_endpoints()
+            for endpoint in self.endpoints:
+                info('Connecting to Ice server %s (%s:%d)', endpoint.name, endpoint.host, endpoint.port)
+                base = ice.stringToProxy('Meta:tcp -h %s -p %d' % (endpoint.host, endpoint.port))
+                endpoint.meta = endpoint.context(Murmur.MetaPrx.uncheckedCast(base))
+
+                endpoint.metacb = Murmur.MetaCallbackPrx.uncheckedCast(addServant(metaCallback(self, endpoint),
+                                                                                  endpoint))
+                endpoint.servercb = Murmur.ServerCallbackPrx.uncheckedCast(addServant(servercb, endpoint))
+                endpoint.auth = Murmur.ServerUpdatingAuthenticatorPrx.uncheckedCast(
+                    addServant(self.authenticator, endpoint))
+
+            if cfg.warmup.enabled:
+                self.warmUp()
+            if cfg.user.avatar_enable and 'characters' not in warmup_report:
+                self.loadCharacters()
+
+            # Endpoints that can not be reached yet are left to the watchdog
+            attached = [self.attachCallbacks(endpoint) for endpoint in self.endpoints]
+            return any(attached)
+
+        def warmUp(self):
+            """
+            Runs the warm-up for the users connected to our virtual servers,
+            attaching goes ahead after [warmup] timeout seconds at the latest
+            """
+            deadline = time.monotonic() + cfg.warmup.timeout
 
-        def attachCallbacks(self, quiet=False):
+            def run():
+                try:
+                    user_ids = set()
+                    for endpoint, sid, server in self.authenticatedServers():
+                        user_ids.update(user.userid - cfg.user.id_offset for user in server.getUsers().values()
+                                        if user.userid > cfg.user.id_offset)
+                except Ice.Exception as e:
+                    debug('Warm-up could not list the connected users: %s', str(e))
+                warm_up(user_ids, self.authenticator.texture_cache, deadline)
+
+            worker = threading.Thread(target=run, name='warmup', daemon=True)
+            worker.start()
+            worker.join(cfg.warmup.timeout)
+            if worker.is_alive():
+                warning('Warm-up did not finish within %.1fs, attaching anyway', cfg.warmup.timeout)
+
+        def attachCallbacks(self, endpoint, quiet=False):
             """
             Attaches all callbacks for meta and authenticators
             """
@@ -377,117 +3372,190 @@ def do_main_program():
             # debug('Attaching callbacks')
             try:
                 if not quiet:
-                    info('Attaching meta callback')
+                    info('Attaching meta callback to %s', endpoint.name)
 
-                self.meta.addCallback(self.metacb)
+                endpoint.meta.addCallback(endpoint.metacb)
 
-                for server in self.meta.getBootedServers():
-                    if not cfg.murmur.servers or server.id() in cfg.murmur.servers:
-                        if not quiet:
-                            info('Setting authenticator for virtual server %d', server.id())
-                        server.setAuthenticator(self.auth)
-                        server.addCallback(self.servercb)
-                        if cfg.idlerhandler.enabled is True:
-                            idler_handler(server)
+                for sid, server in endpoint.booted_servers():
+                    if not quiet:
+                        info('Setting authenticator for virtual server %s', endpoint.label(sid))
+                    server.setAuthenticator(endpoint.auth)
+                    server.addCallback(endpoint.servercb)
 
             except (Murmur.InvalidSecretException,
                     Ice.UnknownUserException,
                     Ice.ConnectionRefusedException) as e:
                 if isinstance(e, Ice.ConnectionRefusedException):
-                    error('Server refused connection')
+                    error('Server %s refused connection', endpoint.name)
                 elif isinstance(e, Murmur.InvalidSecretException) or \
                     isinstance(e, Ice.UnknownUserException) and (
                         e.unknown == 'Murmur::InvalidSecretException'):
-                    error('Invalid ice secret')
+                    error('Invalid ice secret for %s', endpoint.name)
                 else:
                     # We do not actually want to handle this one, re-raise it
                     raise e
 
-                self.connected = False
+                endpoint.lost()
                 return False
 
-            self.connected = True
+            self.watchConnection(endpoint)
+            downtime = endpoint.attached()
+            if downtime is not None:
+                info('Reattached to %s after %.1fs', endpoint.name, downtime)
             return True
 
-        def checkConnection(self):
+        def watchConnection(self, endpoint):
+            """
+            Reattaches as soon as the connection to the Meta server closes,
+            for example when Murmur restarts, instead of waiting for the
+            watchdog. Heartbeats keep Murmur from closing the connection
+            while it is idle, so a close always means it went away.
+            """
+            try:
+                connection = endpoint.meta.ice_getConnection()
+                if cfg.ice.heartbeat > 0:
+                    connection.setACM(cfg.ice.heartbeat, Ice.ACMClose.CloseOff, Ice.ACMHeartbeat.HeartbeatAlways)
+                connection.setCloseCallback(lambda connection: self.connectionLost(endpoint))
+            except Ice.Exception as e:
+                debug('Could not watch the connection to %s: %s', endpoint.name, str(e))
+
+        def connectionLost(self, endpoint):
+            if draining or self.interruptedBy is not None:
+                return
+            with self.reconnectLock:
+                if endpoint.reconnecting:
+                    return
+                endpoint.reconnecting = True
+            warning('Lost connection to %s, reattaching', endpoint.name)
+            endpoint.lost()
+            # Not from the Ice thread delivering the close
+            endpoint.reconnector = Timer(0, self.reconnect, (endpoint, 0))
+            endpoint.reconnector.start()
+
+        def reconnect(self, endpoint, attempt):
+            """
+            Tries to reattach after a lost connection, retrying with
+            exponential backoff until it succeeds
+            """
+            if draining or self.interruptedBy is not None:
+                return
+            try:
+                attached = self.attachCallbacks(endpoint, quiet=attempt > 0)
+            except Ice.Exception as e:
+                debug('Reattaching to %s failed: %s', endpoint.name, str(e) or e.__class__.__name__)
+                attached = False
+            if attached:
+                with self.reconnectLock:
+                    endpoint.reconnecting = False
+                return
+
+            delay = min(cfg.ice.reconnect_backoff * 2 ** attempt, cfg.ice.reconnect_backoff_max)
+            endpoint.reconnector = Timer(delay, self.reconnect, (endpoint, attempt + 1))
+            endpoint.reconnector.start()
+
+        def checkConnection(self, endpoint):
             """
             Tries reapplies all callbacks to make sure the authenticator
-            survives server restarts and disconnects.
+            survives server restarts and disconnects. Every endpoint has
+            a watchdog of its own, a backstop for connection losses that
+            watchConnection did not catch.
             """
             # debug('Watchdog run')
+            if draining:
+                return
 
             try:
-                if not self.attachCallbacks(quiet=not self.failedWatch):
-                    self.failedWatch = True
+                if not self.attachCallbacks(endpoint, quiet=not endpoint.failedWatch):
+                    endpoint.failedWatch = True
                 else:
-                    self.failedWatch = False
+                    endpoint.failedWatch = False
             except Ice.Exception as e:
-                error('Failed connection check, will retry in next watchdog run (%ds)',
-                      cfg.ice.watchdog)
+                error('Failed connection check for %s, will retry in next watchdog run (%ds)',
+                      endpoint.name, cfg.ice.watchdog)
                 debug(str(e))
-                self.failedWatch = True
-
-            # Renew the timer
-            self.watchdog = Timer(cfg.ice.watchdog, self.checkConnection)
-            self.watchdog.start()
+                endpoint.failedWatch = True
 
-    def checkSecret(func):
-        """
-        Decorator that checks whether the server transmitted the right secret
-        if a secret is supposed to be used.
-        """
-        if not cfg.ice.secret:
-            return func
-
-        def newfunc(*args, **kws):
-            if 'current' in kws:
-                current = kws["current"]
-            else:
-                current = args[-1]
-
-            if not current or 'secret' not in current.ctx or current.ctx['secret'] != cfg.ice.secret:
-                error('Server transmitted invalid secret. Possible injection attempt.')
-                raise Murmur.InvalidSecretException()
+            if endpoint.failedWatch:
+                # The connection watch missed it, retry quickly from here on
+                self.connectionLost(endpoint)
 
-            return func(*args, **kws)
+            # Renew the timer
+            endpoint.watchdog = Timer(cfg.ice.watchdog, self.checkConnection, (endpoint,))
+            endpoint.watchdog.start()
 
-        return newfunc
+        def authenticatedServers(self):
+            """
+            Yields (endpoint, id, proxy) of all virtual servers we authenticate
+            for, skipping endpoints that can not be reached right now
+            """
+            for endpoint in self.endpoints:
+                try:
+                    servers = endpoint.booted_servers()
+                except Ice.Exception as e:
+                    debug('Could not list virtual servers of %s: %s', endpoint.name, str(e))
+                    continue
+                for sid, server in servers:
+                    yield endpoint, sid, server
+
+        def idleSweep(self, generation):
+            """
+            Moves idle users on all authenticated virtual servers
+            """
+            try:
+                for endpoint, sid, server in self.authenticatedServers():
+                    idler_handler(server)
+            except Ice.Exception as e:
+                error('Idle handler failed, will retry in next run (%ds)',
+                      cfg.idlerhandler.interval)
+                debug(str(e))
 
-    def fortifyIceFu(retval=None, exceptions=(Ice.Exception,)):
-        """
-        Decorator that catches exceptions,logs them and returns a safe retval
-        value. This helps preventing the authenticator getting stuck in
-        critical code paths. Only exceptions that are instances of classes
-        given in the exceptions list are not caught.
+            if generation == self.jobGeneration:
+                self.idler = Timer(cfg.idlerhandler.interval, self.idleSweep, (generation,))
+                self.idler.start()
 
-        The default is to catch all non-Ice exceptions.
-        """
+        def reconcileSessions(self, generation):
+            """
+            Applies group and display name changes to the users connected to
+            all authenticated virtual servers
+            """
+            # Grants of logins that never became a session would pile up
+            expire_grants(2 * cfg.reconciler.interval)
+            try:
+                for endpoint, sid, server in self.authenticatedServers():
+                    reconcile_sessions(server, endpoint.label(sid))
+            except Ice.Exception as e:
+                error('Session reconciliation failed, will retry in next run (%ds)',
+                      cfg.reconciler.interval)
+                debug(str(e))
 
-        def newdec(func):
-            def newfunc(*args, **kws):
-                try:
-                    return func(*args, **kws)
-                except Exception as e:
-                    catch = True
-                    for ex in exceptions:
-                        if isinstance(e, ex):
-                            catch = False
-                            break
-
-                    if catch:
-                        critical('Unexpected exception caught')
-                        exception(e)
-                        return retval
-                    raise
+            if generation == self.jobGeneration:
+                self.reconciler = Timer(cfg.reconciler.interval, self.reconcileSessions, (generation,))
+                self.reconciler.start()
 
-            return newfunc
+        def loadCharacters(self):
+            """
+            Bulk loads the main characters of the users already connected to
+            the authenticated virtual servers for their avatars, later users
+            are loaded on their first texture lookup
+            """
+            try:
+                user_ids = set()
+                for endpoint, sid, server in self.authenticatedServers():
+                    user_ids.update(user.userid - cfg.user.id_offset for user in server.getUsers().values()
+                                    if user.userid > cfg.user.id_offset)
+                refresh_main_characters(user_ids)
+            except (Ice.Exception, threadDbException) as e:
+                warning('Could not load the main characters of connected users, loading them on demand')
+                debug(str(e))
+            threadDB.release()
 
-        return newdec
+    checkSecret = secret_checker(Murmur.InvalidSecretException)
 
     class metaCallback(Murmur.MetaCallback):
-        def __init__(self, app):
+        def __init__(self, app, endpoint):
             Murmur.MetaCallback.__init__(self)
             self.app = app
+            self.endpoint = endpoint
 
         @fortifyIceFu()
         @checkSecret
@@ -496,10 +3564,21 @@ def do_main_program():
             This function is called when a virtual server is started
             and makes sure an authenticator gets attached if needed.
             """
-            if not cfg.murmur.servers or server.id() in cfg.murmur.servers:
-                info('Setting authenticator for virtual server %d', server.id())
+            server = self.endpoint.context(server)
+            sid = server.id()
+            if draining:
+                debug('Virtual server %s got started while draining', self.endpoint.label(sid))
+            elif self.endpoint.serves(sid):
+                stopped_at = self.endpoint.stopped_at.pop(sid, None)
+                if stopped_at is None:
+                    info('Setting authenticator for virtual server %s', self.endpoint.label(sid))
+                else:
+                    info('Setting authenticator for virtual server %s, %.1fs after it stopped',
+                         self.endpoint.label(sid), time.monotonic() - stopped_at)
                 try:
-                    server.setAuthenticator(app.auth)
+                    # A stopped server forgets its callbacks as well
+                    server.setAuthenticator(self.endpoint.auth)
+                    server.addCallback(self.endpoint.servercb)
                 # Apparently this server was restarted without us noticing
                 except (Murmur.InvalidSecretException, Ice.UnknownUserException) as e:
                     if hasattr(e, "unknown") and e.unknown != "Murmur::InvalidSecretException":
@@ -509,7 +3588,7 @@ def do_main_program():
                     error('Invalid ice secret')
                     return
             else:
-                debug('Virtual server %d got started', server.id())
+                debug('Virtual server %s got started', self.endpoint.label(sid))
 
         @fortifyIceFu()
         @checkSecret
@@ -517,17 +3596,19 @@ def do_main_program():
             """
             This function is called when a virtual server is stopped
             """
-            if self.app.connected:
+            if self.endpoint.connected:
                 # Only try to output the server id if we think we are still connected to prevent
                 # flooding of our thread pool
                 try:
-                    if not cfg.murmur.servers or server.id() in cfg.murmur.servers:
-                        info('Authenticated virtual server %d got stopped', server.id())
+                    sid = self.endpoint.context(server).id()
+                    if self.endpoint.serves(sid):
+                        info('Authenticated virtual server %s got stopped', self.endpoint.label(sid))
+                        self.endpoint.stopped_at[sid] = time.monotonic()
                     else:
-                        debug('Virtual server %d got stopped', server.id())
+                        debug('Virtual server %s got stopped', self.endpoint.label(sid))
                     return
                 except Ice.ConnectionRefusedException:
-                    self.app.connected = False
+                    self.endpoint.connected = False
 
             debug('Server shutdown stopped a virtual server')
 
@@ -541,29 +3622,23 @@ def do_main_program():
             Murmur.ServerCallback.__init__(self)
             self.app = app
 
+        @traced
+        @admitted('callback', shed=queued(connected_update))
         def userConnected(self, user, current=None):
             try:
-                sql = 'UPDATE %smumble_mumbleuser ' \
-                      'SET `release` = %%s, `version` = %%s, `last_connect` = %%s ' \
-                      'WHERE `user_id` = %%s' % cfg.database.prefix
-                cur = threadDB.execute(sql, [user.release,
-                                             user.version,
-                                             datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                                             user.userid - cfg.user.id_offset])
-                cur.close()
+                session_writes.execute(*connected_update(user))
             except threadDbException as e:
                 error('Please Update and Migrate Alliance Auth! \
                        Database Version incorrect! Error: UserConnect')
                 error(e)
 
+        @traced
+        @admitted('callback', shed=queued(disconnected_update))
         def userDisconnected(self, user, current=None):
+            # Loaded again on demand should another session of the user remain
+            main_characters.pop(user.userid - cfg.user.id_offset, None)
             try:
-                sql = 'UPDATE %smumble_mumbleuser ' \
-                      'SET `last_disconnect` = %%s ' \
-                      'WHERE user_id = %%s' % cfg.database.prefix
-                cur = threadDB.execute(sql, [datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                                             user.userid - cfg.user.id_offset])
-                cur.close()
+                session_writes.execute(*disconnected_update(user))
             except threadDbException as e:
                 error('Please Update and Migrate Alliance Auth! \
                        Database Version incorrect! Error: UserDisconnect')
@@ -587,8 +3662,11 @@ def do_main_program():
         def __init__(self):
             Murmur.ServerUpdatingAuthenticator.__init__(self)
 
+        @traced
         @fortifyIceFu(authenticateFortifyResult)
         @checkSecret
+        # Shed logins fall through to Murmur instead of being refused
+        @admitted('auth', (-2, None, None))
         def authenticate(self, name, pw, certlist, certhash, strong,
                          current=None):
             """
@@ -608,8 +3686,8 @@ def do_main_program():
                 sql = 'SELECT `user_id`, `pwhash`, `groups`, `hashfn` ' \
                       'FROM %smumble_mumbleuser ' \
                       'WHERE `username` = %%s' % cfg.database.prefix
-                cur = threadDB.execute(sql, [name])
-                debug('User Authenticated {0}'.format(name))
+                cur = threadDB.read(sql, [name])
+                debug('User Authenticated %s', name)
             except threadDbException:
                 return (FALL_THROUGH, None, None)
 
@@ -627,7 +3705,7 @@ def do_main_program():
                 sql = 'SELECT `display_name`, `user_id` ' \
                       'FROM %smumble_mumbleuser ' \
                       'WHERE `username` = %%s' % cfg.database.prefix
-                cur = threadDB.execute(sql, [name])
+                cur = threadDB.read(sql, [name])
                 res = cur.fetchone()
                 cur.close()
                 if res:
@@ -642,17 +3720,22 @@ def do_main_program():
                 error(e)
                 display_name = name
 
-            if ugroups:
-                groups = ugroups.split(',')
-            else:
-                groups = []
+            groups = parse_groups(ugroups)
 
-            debug('checking password with hash function: %s' % uhashfn)
+            debug('checking password with hash function: %s', uhashfn)
 
-            if allianceauth_check_hash(pw, upwhash, uhashfn):
+            with span('hash', uhashfn):
+                valid = allianceauth_check_hash(pw, upwhash, uhashfn)
+            if valid:
                 info('User authenticated: "%s" (%d)',
                      display_name, uid + cfg.user.id_offset)
-                debug('Group memberships: %s', str(groups))
+                # The main may have changed since the last login, reload it
+                # on the next texture lookup
+                main_characters.pop(uid, None)
+                debug('Group memberships: %s', groups)
+
+                if cfg.reconciler.enabled:
+                    add_grant(uid + cfg.user.id_offset, entity_decode(display_name), groups)
 
                 return (uid + cfg.user.id_offset,
                         entity_decode(display_name),
@@ -673,8 +3756,10 @@ def do_main_program():
             debug('getInfo for %d -> denied', id)
             return (False, None)
 
+        @traced
         @fortifyIceFu(-2)
         @checkSecret
+        @admitted('lookup', -2)
         def nameToId(self, name, current=None):
             """
             Gets called to get the id for a given username
@@ -687,7 +3772,7 @@ def do_main_program():
 
             try:
                 sql = 'SELECT user_id FROM %smumble_mumbleuser WHERE username = %%s' % cfg.database.prefix
-                cur = threadDB.execute(sql, [name])
+                cur = threadDB.read(sql, [name])
             except threadDbException:
                 return FALL_THROUGH
 
@@ -700,8 +3785,10 @@ def do_main_program():
             debug('nameToId %s -> %d', name, (res[0] + cfg.user.id_offset))
             return res[0] + cfg.user.id_offset
 
+        @traced
         @fortifyIceFu("")
         @checkSecret
+        @admitted('lookup', "")
         def idToName(self, id, current=None):
             """
             Gets called to get the username for a given id
@@ -716,7 +3803,7 @@ def do_main_program():
             # Fetch the user from the database
             try:
                 sql = 'SELECT username FROM %smumble_mumbleuser WHERE user_id = %%s' % cfg.database.prefix
-                cur = threadDB.execute(sql, [bbid])
+                cur = threadDB.read(sql, [bbid])
             except threadDbException:
                 return FALL_THROUGH
 
@@ -733,8 +3820,10 @@ def do_main_program():
             debug('idToName %d -> ?', id)
             return FALL_THROUGH
 
+        @traced
         @fortifyIceFu("")
         @checkSecret
+        @admitted('texture', "")
         def idToTexture(self, id, current=None):
             """
             Gets called to get the corresponding texture for a user
@@ -745,26 +3834,27 @@ def do_main_program():
                 debug('idToTexture %d -> avatar display disabled, fall through', id)
                 return FALL_THROUGH
 
-            # Otherwise get the CCP character ID from AAuth DB.
-            try:
-                if id > cfg.user.id_offset:
-                    bbid = id - cfg.user.id_offset
-                    sql = "SELECT REPLACE('%s', '{charid}', eec.character_id) " \
-                          'FROM %seveonline_evecharacter AS `eec`,' \
-                          '%sauthentication_userprofile AS `aup` ' \
-                          'WHERE (aup.user_id = %%s) AND (aup.main_character_id = eec.id)' \
-                        % (cfg.user.ccp_avatar_url, cfg.database.prefix, cfg.database.prefix)
-                cur = threadDB.execute(sql, [bbid])
-            except threadDbException:
-                debug('idToTexture %d -> DB error for query "%s", fall through', id, sql)
+            if id <= cfg.user.id_offset:
+                debug('idToTexture %d -> not an AllianceAuth user, fall through', id)
                 return FALL_THROUGH
+            bbid = id - cfg.user.id_offset
 
-            res = cur.fetchone()
-            cur.close()
-            if not res:
+            # Otherwise get the CCP character ID, connected users are bulk loaded
+            try:
+                charid = main_characters[bbid]
+            except KeyError:
+                # Connected since the last refresh
+                try:
+                    charid = load_main_characters([bbid])[bbid]
+                except threadDbException:
+                    debug('idToTexture %d -> DB error, fall through', id)
+                    return FALL_THROUGH
+                main_characters[bbid] = charid
+
+            if charid is None:
                 debug('idToTexture %d -> user unknown, fall through', id)
                 return FALL_THROUGH
-            avatar_file = res[0]
+            avatar_file = avatar_url(charid)
 
             # If we found a character ID, avatar_file contains image URL.
             if avatar_file:
@@ -778,16 +3868,13 @@ def do_main_program():
                 # Should work under Python 2.4+ and 3.x.
                 try:
                     debug('idToTexture %d -> try file "%s"', id, avatar_file)
-                    handle = urlopen(avatar_file)
+                    file = download_texture(avatar_file)
 
                 except (IOError, Exception):
                     e = sys.exc_info()[1]      # Python 2.4 compatible
                     debug('idToTexture %d -> image download for "%s" failed: "%s", fall through',
                           id, avatar_file, str(e))
                     return FALL_THROUGH
-                else:
-                    file = handle.read()
-                    handle.close()
 
                 # Cache resulting avatar by file address and return image.
                 self.texture_cache[avatar_file] = file
@@ -822,30 +3909,41 @@ def do_main_program():
             debug('unregisterUser %d -> fall through', id)
             return FALL_THROUGH
 
+        @traced
         @fortifyIceFu({})
         @checkSecret
+        @admitted('list', {})
         def getRegisteredUsers(self, filter, current=None):
             """
             Returns a list of usernames in the AllianceAuth database which contain
             filter as a substring.
             """
 
+            limit = cfg.user.registered_limit
+            cache = user_cache
+            if cache is not None:
+                res = itertools.islice(cache.search(filter or ''), limit)
+                users = dict([(a + cfg.user.id_offset, b) for a, b in res])
+                debug('getRegisteredUsers -> %d indexed results for filter "%s"', len(users), filter)
+                return users
+
             if not filter:
                 filter = '%'
 
             try:
-                sql = 'SELECT user_id, username FROM %smumble_mumbleuser WHERE username LIKE %%s' % cfg.database.prefix
-                cur = threadDB.execute(sql, [filter])
+                sql = 'SELECT user_id, username FROM %smumble_mumbleuser WHERE username LIKE %%s LIMIT %d' \
+                      % (cfg.database.prefix, limit)
+                cur = threadDB.read(sql, [filter])
             except threadDbException:
                 return {}
 
-            res = cur.fetchall()
+            users = dict([(a + cfg.user.id_offset, b) for a, b in cur])
             cur.close()
-            if not res:
+            if not users:
                 debug('getRegisteredUsers -> empty list for filter "%s"', filter)
                 return {}
-            debug('getRegisteredUsers -> %d results for filter "%s"', len(res), filter)
-            return dict([(a + cfg.user.id_offset, b) for a, b in res])
+            debug('getRegisteredUsers -> %d results for filter "%s"', len(users), filter)
+            return users
 
         @fortifyIceFu(-1)
         @checkSecret
@@ -900,18 +3998,36 @@ def do_main_program():
     # --- Start of authenticator
     #
     info('Starting AllianceAuth Mumble authenticator V:%s - %s' % (__version__, __branch__))
+    threadDB.setup()
+    if cfg.database.explain:
+        advise_indexes()
+    restart_replica_checks()
+    restart_user_cache()
+    setup_admission()
+    restart_pool_controller()
+    if cfg.texture.transcode and Image is None:
+        warning('Texture transcoding needs Pillow, which is not installed, textures are passed on as is')
     initdata = Ice.InitializationData()
     initdata.properties = Ice.createProperties([], initdata.properties)
     for prop, val in cfg.iceraw:
         initdata.properties.setProperty(prop, val)
+    if cfg.pool.enabled:
+        # Ice grows the pool under load and shrinks it again when threads are idle
+        initdata.properties.setProperty('Ice.ThreadPool.Server.Size', str(cfg.pool.threads_min))
+        initdata.properties.setProperty('Ice.ThreadPool.Server.SizeMax', str(cfg.pool.threads_max))
 
     initdata.properties.setProperty('Ice.ImplicitContext', 'Shared')
     initdata.properties.setProperty('Ice.Default.EncodingVersion', '1.0')
     initdata.logger = CustomLogger()
 
+    # Dump all thread stacks to the log on SIGUSR1
+    signal.signal(signal.SIGUSR1, lambda signum, frame: warning('Thread stacks:\n%s', dump_stacks()))
+
     app = allianceauthauthenticatorApp()
     state = app.main(sys.argv[:1], initData=initdata)
     info('Shutdown complete')
+    stop_async_logging()
+    return state
 
 
 def allianceauth_check_hash(password, hash, hash_type):
@@ -922,11 +4038,12 @@ def allianceauth_check_hash(password, hash, hash_type):
     :param hash_type: Hashing function originally used to generate the hash
     """
     if hash_type == 'sha1':
-        return sha1(password).hexdigest() == hash
+        # Murmur hands the password over as str, hashlib wants bytes
+        return sha1(password.encode('utf-8')).hexdigest() == hash
     elif hash_type == 'bcrypt-sha256':
         return bcrypt_sha256.verify(password, hash)
     else:
-        warning("No valid hash function found for %s" % hash_type)
+        warning("No valid hash function found for %s", hash_type)
         return False
 
 
@@ -935,15 +4052,13 @@ def idler_handler(server):
     users = server.getUsers().values()
     debug('IdleHandler: Fetched All Users')
     for user in users:
-        debug("IdleHandler: Checking user {0}".format(user.name))
+        debug("IdleHandler: Checking user %s", user.name)
         if isinstance(user, int):
-            debug("IdleHandler: Skipping User {0}, This happens occasionally".format(user.name))
+            debug("IdleHandler: Skipping User %s, This happens occasionally", user.name)
             continue
 
         if user.idlesecs > cfg.idlerhandler.time:
-            debug('IdleHandler: User {0} is AFK, for {1}/{2}'.format(user.name,
-                                                                     user.idlesecs,
-                                                                     cfg.idlerhandler.time))
+            debug('IdleHandler: User %s is AFK, for %d/%d', user.name, user.idlesecs, cfg.idlerhandler.time)
             state = server.getState(user.session)
             if state:
                 # Check If the allow and deny lists are defined
@@ -971,9 +4086,7 @@ def idler_handler(server):
                     state.selfMute = True
                     state.selfDeaf = True
                     server.setState(state)
-                    debug('IdleHandler: Moved AFK User {0}'.format(user.name))
-
-    Timer(cfg.idlerhandler.interval, idler_handler, (server,)).start()
+                    debug('IdleHandler: Moved AFK User %s', user.name)
 
 #
 # --- Start of program
@@ -993,28 +4106,61 @@ if __name__ == '__main__':
                       help='run as daemon', default=False)
     parser.add_option('-a', '--app', action='store_true', dest='force_app',
                       help='do not run as daemon', default=False)
+    parser.add_option('--admin', dest='admin_command', metavar='COMMAND',
+                      help='send COMMAND (stacks, profile <seconds>, state) to the admin socket '
+                           'of the running authenticator and exit')
+    parser.add_option('--worker', type='int', dest='admin_worker', metavar='SLOT',
+                      help='send the --admin command to worker SLOT when running with [workers]')
+    parser.add_option('--create-sqlite-schema', action='store_true', dest='create_schema',
+                      help='create the tables the authenticator uses in the SQLite database and exit', default=False)
+    parser.add_option('--compile-slices', action='store_true', dest='compile_slices',
+                      help='precompile the bundled slices into the slice cache and exit', default=False)
     (option, args) = parser.parse_args()
 
+    if option.compile_slices:
+        for slice in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'slices', '*.ice'))):
+            start = time.perf_counter()
+            target = compile_slice(slice)
+            print('Compiled %s into %s in %.1fms' % (slice, target, (time.perf_counter() - start) * 1000))
+        sys.exit(0)
+
     if option.force_daemon and option.force_app:
         parser.print_help()
         sys.exit(1)
 
     # Load configuration
+    cfgfile = option.ini
     try:
-        cfg = config(option.ini, default)
+        cfg = config(cfgfile, default)
     except Exception as e:
         eprint('Fatal error, could not load config file from "%s"' % cfgfile)
         error(e)
         sys.exit(1)
 
+    if option.admin_command:
+        try:
+            print(admin_command(admin_socket(option.admin_worker), option.admin_command), end='')
+        except OSError as e:
+            eprint('Could not reach admin socket "%s": %s' % (admin_socket(option.admin_worker), str(e)))
+            sys.exit(1)
+        sys.exit(0)
+
     try:
-        db = __import__(cfg.database.lib)
+        db = load_backend(cfg.database.lib)
     except ImportError as e:
         eprint('Fatal error, could not import database library "%s", '
                'please install the missing dependency and restart the authenticator' % cfg.database.lib)
         error(e)
         sys.exit(1)
 
+    if option.create_schema:
+        if not isinstance(db, sqliteBackend):
+            eprint('Fatal error, --create-sqlite-schema needs lib = sqlite3 in [database]')
+            sys.exit(1)
+        db.create_schema()
+        print('Created the authenticator tables in %s' % cfg.database.name)
+        sys.exit(0)
+
     # Initialize logger
     if cfg.log.file:
         try:
@@ -1027,14 +4173,20 @@ if __name__ == '__main__':
     else:
         logfile = logging.sys.stderr
 
+    log_quiet = not option.verbose
     if option.verbose:
         level = cfg.log.level
     else:
         level = logging.ERROR
 
+    # Tell the worker processes apart when running under the supervisor
     logging.basicConfig(level=level,
-                        format='%(asctime)s %(levelname)s %(message)s',
+                        format='%(asctime)s %(levelname)s ' +
+                               ('[%(process)d] ' if cfg.workers.count > 1 else '') + '%(message)s',
                         stream=logfile)
+    if cfg.log.rate_limit > 0:
+        for handler in getLogger().handlers:
+            handler.addFilter(rateLimitFilter(cfg.log.rate_limit, cfg.log.rate_window))
 
     # As the default try to run as daemon. Silently degrade to running as a normal application if this fails
     # unless the user explicitly defined what he expected with the -a / -d parameter.
@@ -1047,12 +4199,12 @@ if __name__ == '__main__':
             eprint('Fatal error, could not daemonize process due to missing "daemon" library, '
                    'please install the missing dependency and restart the authenticator')
             sys.exit(1)
-        do_main_program()
+        run_program()
     else:
         context = daemon.DaemonContext(working_directory=sys.path[0],
                                        stderr=logfile)
         context.__enter__()
         try:
-            do_main_program()
+            run_program()
         finally:
             context.__exit__(None, None, None)
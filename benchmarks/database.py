@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Database driver benchmark for the statements on the request paths.
+
+Runs the authenticate, nameToId, idToName, display name and main character
+statements through threadDB with every available driver. SQLite runs on a
+temporary database created with the authenticator schema and filled with
+synthetic users. MySQLdb and PyMySQL need a server, given by the [database]
+section of an authenticator.ini and an existing username, and only run
+reads there.
+
+    python benchmarks/database.py --users 20000
+    python benchmarks/database.py -i authenticator.ini --username some_user -o drivers.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import string
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import authenticator  # noqa: E402
+from authenticator import config, default, hot_queries, load_backend, threadDB  # noqa: E402
+from hotpaths import EXAMPLE_INI, measure  # noqa: E402
+
+LIBS = ('sqlite3', 'pymysql', 'MySQLdb')
+
+# The statements the benchmark runs, writes are left out so it can run
+# against a live Alliance Auth database
+STATEMENTS = ('authenticate', 'display name', 'nameToId', 'idToName', 'main characters')
+
+
+def fill_sqlite(backend, count, seed=1):
+    """
+    Creates the schema and count synthetic users, returns a (username,
+    user_id) pair in the middle of the table
+    """
+    backend.create_schema()
+    rng = random.Random(seed)
+    prefix = authenticator.cfg.database.prefix
+    users = []
+    for uid in range(1, count + 1):
+        name = '%s_%d' % (''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 12))), uid)
+        users.append((uid, name, 'x' * 60, 'bcrypt-sha256', 'Member,Corp_%d' % (uid % 50), uid, 'Pilot %d' % uid))
+    con = backend.connect(None, None)
+    try:
+        con.executemany('INSERT INTO %smumble_mumbleuser (`id`, `username`, `pwhash`, `hashfn`, `groups`, '
+                        '`user_id`, `display_name`) VALUES (?, ?, ?, ?, ?, ?, ?)' % prefix, users)
+        con.executemany('INSERT INTO %seveonline_evecharacter (`id`, `character_id`, `character_name`) '
+                        'VALUES (?, ?, ?)' % prefix, [(uid, 90000000 + uid, 'Pilot %d' % uid) for uid, *_ in users])
+        con.executemany('INSERT INTO %sauthentication_userprofile (`id`, `user_id`, `main_character_id`) '
+                        'VALUES (?, ?, ?)' % prefix, [(uid, uid, uid) for uid, *_ in users])
+    finally:
+        con.close()
+    middle = users[count // 2]
+    return middle[1], middle[5]
+
+
+def find_user(username):
+    """
+    Looks up the user id of an existing user on a MySQL server
+    """
+    cur = threadDB.execute('SELECT user_id FROM %smumble_mumbleuser WHERE username = %%s'
+                           % authenticator.cfg.database.prefix, [username])
+    try:
+        row = cur.fetchone()
+    finally:
+        cur.close()
+    if row is None:
+        raise SystemExit('User "%s" not found' % username)
+    return username, row[0]
+
+
+def run_statement(sql, args):
+    cur = threadDB.execute(sql, args)
+    cur.fetchall()
+    cur.close()
+
+
+def bench_driver(lib, args):
+    """
+    Times the statements with one driver, returns the results by statement
+    or None if the driver or its server is not available
+    """
+    cfg = config(args.ini or EXAMPLE_INI, default)
+    cfg.database.lib = lib
+    cfg.database.replicas = []
+    cfg.pool.enabled = False
+    tmpdir = None
+    if lib == 'sqlite3':
+        tmpdir = tempfile.mkdtemp(prefix='authenticator-bench-')
+        cfg.database.name = os.path.join(tmpdir, 'auth.sqlite3')
+    elif not args.ini or not args.username:
+        print('%-8s skipped, needs --ini and --username for a MySQL server' % lib)
+        return None
+    authenticator.cfg = cfg
+
+    try:
+        authenticator.db = load_backend(lib)
+    except ImportError:
+        print('%-8s skipped, not installed' % lib)
+        return None
+    threadDB.setup()
+    try:
+        try:
+            if lib == 'sqlite3':
+                username, user_id = fill_sqlite(authenticator.db, args.users)
+            else:
+                username, user_id = find_user(args.username)
+        except (authenticator.threadDbException, authenticator.db.Error) as e:
+            print('%-8s skipped, database not available: %s' % (lib, str(e) or e.__class__.__name__))
+            return None
+
+        results = {}
+        for name, sql, params, index in hot_queries(username, user_id):
+            if name not in STATEMENTS:
+                continue
+            best, median, number = measure(lambda: run_statement(sql, params), args.repeat, args.min_time)
+            results[name] = {'best_us': round(best * 1e6, 3), 'median_us': round(median * 1e6, 3), 'loops': number}
+            print('%-8s %-20s %12.3f us  (median %.3f us, %d loops)' % (lib, name, best * 1e6, median * 1e6, number))
+        return results
+    finally:
+        threadDB.disconnect()
+        if tmpdir:
+            for name in os.listdir(tmpdir):
+                os.unlink(os.path.join(tmpdir, name))
+            os.rmdir(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-i', '--ini', help='authenticator.ini with the MySQL server to benchmark against')
+    parser.add_argument('--username', help='Existing user to look up on the MySQL server')
+    parser.add_argument('-u', '--users', type=int, default=20000, help='Synthetic users in the SQLite database')
+    parser.add_argument('-l', '--lib', action='append', choices=LIBS, help='Only benchmark this driver')
+    parser.add_argument('-o', '--output', help='Save the results as JSON to this file')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Rounds per benchmark')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Minimum seconds per round')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    results = {}
+    for lib in args.lib or LIBS:
+        driver = bench_driver(lib, args)
+        if driver is not None:
+            results[lib] = driver
+
+    if args.output:
+        report = {'created': datetime.datetime.now().isoformat(),
+                  'python': platform.python_version(),
+                  'machine': platform.machine(),
+                  'users': args.users,
+                  'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Saved results to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Micro benchmarks for the pure functions on the authenticator's hot paths.
+
+Runs every benchmark, prints the time per call and optionally saves the
+results as a JSON baseline. A later run can be compared against it, the
+compare command exits non-zero if a benchmark got slower than allowed.
+hotpaths-baseline.json next to this file is the committed baseline.
+
+    python benchmarks/hotpaths.py run -o current.json --compare benchmarks/hotpaths-baseline.json
+    python benchmarks/hotpaths.py run -o baseline.json
+    python benchmarks/hotpaths.py run -o current.json --compare baseline.json
+    python benchmarks/hotpaths.py compare baseline.json current.json --threshold 10
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import string
+import sys
+import timeit
+from hashlib import sha1
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import authenticator  # noqa: E402
+from authenticator import (admitted, allianceauth_check_hash, config, default, entity_decode,  # noqa: E402
+                           entity_encode, fortifyIceFu, idler_handler, parse_groups, secret_checker,
+                           traced, userCache)
+from passlib.hash import bcrypt_sha256  # noqa: E402
+
+EXAMPLE_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'authenticator.ini.example')
+
+
+class invalidSecret(Exception):
+    pass
+
+
+class fakeIdentity(object):
+    name = 'benchmark'
+
+
+class fakeCurrent(object):
+    def __init__(self, secret):
+        self.ctx = {'secret': secret}
+        self.id = fakeIdentity()
+
+
+class fakeState(object):
+    def __init__(self, channel):
+        self.channel = channel
+        self.selfMute = False
+        self.selfDeaf = False
+
+
+class fakeUser(object):
+    def __init__(self, session, name, idlesecs, channel):
+        self.session = session
+        self.name = name
+        self.idlesecs = idlesecs
+        self.channel = channel
+
+
+class fakeServer(object):
+    """
+    Answers the calls idler_handler makes without Ice
+    """
+
+    def __init__(self, users):
+        self.users = dict((user.session, user) for user in users)
+
+    def getUsers(self):
+        return self.users
+
+    def getState(self, session):
+        return fakeState(self.users[session].channel)
+
+    def setState(self, state):
+        pass
+
+
+def synthetic_users(count, seed=1):
+    rng = random.Random(seed)
+    return [fakeUser(session, 'user%d' % session, rng.choice((0, 30, 600, 4000, 7200)), rng.randint(1, 20))
+            for session in range(1, count + 1)]
+
+
+def synthetic_groups(count, seed=1):
+    rng = random.Random(seed)
+    groups = ['Group_%s' % ''.join(rng.choice(string.ascii_letters) for _ in range(8)) for _ in range(40)]
+    return [','.join(rng.sample(groups, rng.randint(1, 5))) for _ in range(count)]
+
+
+def setup_config():
+    """
+    Loads the example configuration with the settings the benchmarks rely on
+    """
+    cfg = config(EXAMPLE_INI, default)
+    cfg.ice.secret = 'secret'
+    cfg.meta = {}
+    cfg.trace.enabled = False
+    cfg.idlerhandler.time = 3600
+    cfg.idlerhandler.channel = 1
+    cfg.idlerhandler.allowlist = []
+    cfg.idlerhandler.denylist = [5, 6]
+    authenticator.cfg = cfg
+    return cfg
+
+
+def benchmarks():
+    """
+    Returns (name, function) pairs, each function runs one operation
+    """
+    cfg = setup_config()
+    password = 'correct horse battery staple'
+    sha1_hash = sha1(password.encode('utf-8')).hexdigest()
+    # The password as authenticate passes it, a str
+    bench = [('check_hash sha1', lambda: allianceauth_check_hash(password, sha1_hash, 'sha1'))]
+    for rounds in (4, 8, 12):
+        bcrypt_hash = bcrypt_sha256.using(rounds=rounds).hash(password)
+        bench.append(('check_hash bcrypt-sha256 rounds=%d' % rounds,
+                      lambda h=bcrypt_hash: allianceauth_check_hash(password, h, 'bcrypt-sha256')))
+
+    encoded = entity_encode('Tom & Jerry <"the" cat>')
+    bench += [('entity_decode', lambda: entity_decode(encoded)),
+              ('entity_encode', lambda: entity_encode('Tom & Jerry <"the" cat>')),
+              ('config parse', lambda: config(EXAMPLE_INI, default))]
+
+    # Decorator overhead per dispatch, against the undecorated call
+    def dispatch(self, name, current=None):
+        return name
+
+    check_secret = secret_checker(invalidSecret)
+    current = fakeCurrent(cfg.ice.secret)
+    stacked = traced(fortifyIceFu(-1)(check_secret(admitted('auth', -2)(dispatch))))
+    bench += [('dispatch undecorated', lambda: dispatch(None, 'name', current)),
+              ('dispatch fortifyIceFu', lambda f=fortifyIceFu(-1)(dispatch): f(None, 'name', current)),
+              ('dispatch checkSecret', lambda f=check_secret(dispatch): f(None, 'name', current)),
+              ('dispatch full stack', lambda: stacked(None, 'name', current))]
+
+    groups = synthetic_groups(1000)
+    rows = [(uid, 'user%d' % uid, 'User %d' % uid, g) for uid, g in enumerate(groups, 1)]
+
+    def parse_all():
+        for g in groups:
+            parse_groups(g)
+
+    def parse_all_cached():
+        authenticator.user_cache = cache
+        try:
+            parse_all()
+        finally:
+            authenticator.user_cache = None
+
+    cache = userCache(rows)
+    bench += [('parse_groups x1000', parse_all),
+              ('parse_groups x1000 cached', parse_all_cached)]
+
+    server = fakeServer(synthetic_users(500))
+    bench.append(('idler_handler 500 users', lambda: idler_handler(server)))
+    return bench
+
+
+def measure(func, repeat, min_time):
+    """
+    Returns the best and median seconds per call over repeat rounds
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    times = [t / number for t in timer.repeat(repeat, number)]
+    return min(times), statistics.median(times), number
+
+
+def run(args):
+    logging.basicConfig(level=logging.CRITICAL)
+    results = {}
+    for name, func in benchmarks():
+        if args.filter and args.filter not in name:
+            continue
+        best, median, number = measure(func, args.repeat, args.min_time)
+        results[name] = {'best_us': round(best * 1e6, 3), 'median_us': round(median * 1e6, 3), 'loops': number}
+        print('%-40s %12.3f us  (median %.3f us, %d loops)' % (name, best * 1e6, median * 1e6, number))
+
+    report = {'created': datetime.datetime.now().isoformat(),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Saved results to %s' % args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            return compare_reports(json.load(f), report, args.threshold)
+    return 0
+
+
+def compare_reports(baseline, current, threshold):
+    """
+    Prints the change of every benchmark and returns 1 if any got slower
+    than the threshold in percent allows
+    """
+    regressions = 0
+    for name in sorted(set(baseline['results']) | set(current['results'])):
+        old = baseline['results'].get(name)
+        new = current['results'].get(name)
+        if old is None or new is None:
+            print('%-40s %s' % (name, 'only in baseline' if new is None else 'new'))
+            continue
+        change = (new['best_us'] / old['best_us'] - 1) * 100 if old['best_us'] else 0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('%-40s %12.3f -> %12.3f us  %+6.1f%%%s' % (name, old['best_us'], new['best_us'], change, flag))
+    if regressions:
+        print('%d benchmark(s) more than %.0f%% slower than the baseline' % (regressions, threshold))
+        return 1
+    return 0
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    return compare_reports(baseline, current, args.threshold)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('-o', '--output', help='Save the results as JSON to this file')
+    run_parser.add_argument('-c', '--compare', metavar='BASELINE', help='Compare the results against a baseline')
+    run_parser.add_argument('-k', '--filter', help='Only run benchmarks whose name contains this')
+    run_parser.add_argument('-r', '--repeat', type=int, default=5, help='Rounds per benchmark')
+    run_parser.add_argument('--min-time', type=float, default=0.2, help='Minimum seconds per round')
+    run_parser.add_argument('-t', '--threshold', type=float, default=10.0,
+                            help='Allowed slowdown in percent when comparing')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser('compare', help='Compare two saved results')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('-t', '--threshold', type=float, default=10.0, help='Allowed slowdown in percent')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark for the in-process user cache.
+
+Builds the cache from synthetic Alliance Auth users and reports the bytes
+used per user, including the name and display name strings it keeps, next
+to a naive dict of tuples for comparison.
+
+    python benchmarks/memory.py --users 200000
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from authenticator import userCache  # noqa: E402
+
+
+def synthetic_users(count, group_count=60, set_count=400, seed=1):
+    rng = random.Random(seed)
+    groups = ['Group_%s' % ''.join(rng.choice(string.ascii_letters) for _ in range(8))
+              for _ in range(group_count)]
+    # Members of an alliance share a limited number of role combinations
+    group_sets = [','.join(sorted(rng.sample(groups[:12], rng.randint(1, 3)) +
+                                  rng.sample(groups, rng.randint(0, 2))))
+                  for _ in range(set_count)]
+    for uid in range(1, count + 1):
+        name = '%s %s' % (''.join(rng.choice(string.ascii_letters) for _ in range(rng.randint(4, 12))),
+                          ''.join(rng.choice(string.ascii_letters) for _ in range(rng.randint(4, 12))))
+        display_name = '[%s] %s' % (''.join(rng.choice(string.ascii_uppercase) for _ in range(4)), name)
+        yield uid, name.replace(' ', '_'), display_name, rng.choice(group_sets)
+
+
+def fresh(rows):
+    """
+    Yields copies of the rows with new objects, like a database cursor
+    decoding every row, so the strings a layout keeps are counted
+    """
+    for uid, name, display_name, groups in rows:
+        yield int(str(uid)), name.encode().decode(), display_name.encode().decode(), groups.encode().decode()
+
+
+def string_bytes(strings):
+    return sum(sys.getsizeof(s) for s in strings)
+
+
+def measure(build, rows):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build(fresh(rows))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, after - before
+
+
+def naive(rows):
+    return dict((uid, (name, display_name, groups.split(','))) for uid, name, display_name, groups in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-u', '--users', type=int, default=200000, help='Number of synthetic users')
+    args = parser.parse_args()
+
+    rows = list(synthetic_users(args.users))
+    _, naive_bytes = measure(naive, rows)
+    cache, cache_bytes = measure(userCache, rows)
+    strings = string_bytes(cache.names) + string_bytes(cache.display_names)
+
+    print('users:        %d' % args.users)
+    print('groups:       %d (%d distinct sets)' % (len(cache.group_names), len(cache.sets)))
+    print('naive dict:   %.1f bytes/user' % (naive_bytes / args.users))
+    print('userCache:    %.1f bytes/user (%.1f MiB)' % (cache_bytes / args.users, cache_bytes / 2 ** 20))
+    print('  of which names and display names: %.1f bytes/user' % (strings / args.users))
+
+
+if __name__ == '__main__':
+    main()
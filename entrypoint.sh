@@ -54,12 +54,34 @@ password = $(get_cfg_value "MUMBLE_AUTH_DB_PASSWORD" "password")
 prefix = $(get_cfg_value "MUMBLE_AUTH_DB_PREFIX")
 host = $(get_cfg_value "MUMBLE_AUTH_DB_HOST" "127.0.0.1")
 port = $(get_cfg_value "MUMBLE_AUTH_DB_PORT" "3306")
+breaker_threshold = $(get_cfg_value "MUMBLE_AUTH_DB_BREAKER_THRESHOLD" "3")
+breaker_backoff = $(get_cfg_value "MUMBLE_AUTH_DB_BREAKER_BACKOFF" "1")
+breaker_backoff_max = $(get_cfg_value "MUMBLE_AUTH_DB_BREAKER_BACKOFF_MAX" "60")
+replicas = $(get_cfg_value "MUMBLE_AUTH_DB_REPLICAS" "")
+replica_max_lag = $(get_cfg_value "MUMBLE_AUTH_DB_REPLICA_MAX_LAG" "30")
+replica_check_interval = $(get_cfg_value "MUMBLE_AUTH_DB_REPLICA_CHECK_INTERVAL" "10")
+explain = $(get_cfg_value "MUMBLE_AUTH_DB_EXPLAIN" "True")
 
 [user]
 id_offset = $(get_cfg_value "MUMBLE_AUTH_USER_ID_OFFSET" "1000000000")
 reject_on_error = $(get_cfg_value "MUMBLE_AUTH_USER_REJCT_ON_ERROR" "True")
 avatar_enable = $(get_cfg_value "MUMBLE_AUTH_USER_AVATAR_ENABLE" "False")
 ccp_avatar_url = $(get_cfg_value "MUMBLE_AUTH_USER_AVATAR_URL" "https://images.evetech.net/characters/{charid}/portrait?size=32")
+registered_limit = $(get_cfg_value "MUMBLE_AUTH_USER_REGISTERED_LIMIT" "1000")
+
+[texture]
+transcode = $(get_cfg_value "MUMBLE_AUTH_TEXTURE_TRANSCODE" "False")
+size = $(get_cfg_value "MUMBLE_AUTH_TEXTURE_SIZE" "64")
+format = $(get_cfg_value "MUMBLE_AUTH_TEXTURE_FORMAT" "PNG")
+quality = $(get_cfg_value "MUMBLE_AUTH_TEXTURE_QUALITY" "85")
+
+[usercache]
+enabled = $(get_cfg_value "MUMBLE_AUTH_USERCACHE_ENABLED" "True")
+refresh = $(get_cfg_value "MUMBLE_AUTH_USERCACHE_REFRESH" "300")
+
+[reconciler]
+enabled = $(get_cfg_value "MUMBLE_AUTH_RECONCILER_ENABLED" "False")
+interval = $(get_cfg_value "MUMBLE_AUTH_RECONCILER_INTERVAL" "60")
 
 [ice]
 host = $(get_cfg_value "MUMBLE_AUTH_ICE_HOST" "127.0.0.1")
@@ -67,14 +89,67 @@ port = $(get_cfg_value "MUMBLE_AUTH_ICE_PORT" "6502")
 slice = $(get_cfg_value "MUMBLE_AUTH_ICE_SLICE" "slices/murmur-1.5.ice")
 secret = $(get_cfg_value "MUMBLE_AUTH_ICE_SECRET" "")
 watchdog = $(get_cfg_value "MUMBLE_AUTH_ICE_WATCHDOG" "30")
+heartbeat = $(get_cfg_value "MUMBLE_AUTH_ICE_HEARTBEAT" "30")
+reconnect_backoff = $(get_cfg_value "MUMBLE_AUTH_ICE_RECONNECT_BACKOFF" "0.2")
+reconnect_backoff_max = $(get_cfg_value "MUMBLE_AUTH_ICE_RECONNECT_BACKOFF_MAX" "5")
 endpoint = $(get_cfg_value "MUMBLE_AUTH_ICE_ENDPOINT" "0.0.0.0")
 
 [murmur]
 servers = $(get_cfg_value "MUMBLE_AUTH_MURMUR_SERVERS" "1") 
 
+[workers]
+count = $(get_cfg_value "MUMBLE_AUTH_WORKERS_COUNT" "0")
+restart_delay = $(get_cfg_value "MUMBLE_AUTH_WORKERS_RESTART_DELAY" "5")
+max_restarts = $(get_cfg_value "MUMBLE_AUTH_WORKERS_MAX_RESTARTS" "5")
+restart_window = $(get_cfg_value "MUMBLE_AUTH_WORKERS_RESTART_WINDOW" "300")
+stop_timeout = $(get_cfg_value "MUMBLE_AUTH_WORKERS_STOP_TIMEOUT" "30")
+
+[drain]
+enabled = $(get_cfg_value "MUMBLE_AUTH_DRAIN_ENABLED" "True")
+deadline = $(get_cfg_value "MUMBLE_AUTH_DRAIN_DEADLINE" "8")
+
+[warmup]
+enabled = $(get_cfg_value "MUMBLE_AUTH_WARMUP_ENABLED" "True")
+timeout = $(get_cfg_value "MUMBLE_AUTH_WARMUP_TIMEOUT" "10")
+avatars = $(get_cfg_value "MUMBLE_AUTH_WARMUP_AVATARS" "False")
+
 [log]
 level = $(get_cfg_value "MUMBLE_AUTH_LOG_LEVEL" "20") 
 file = $(get_cfg_value "MUMBLE_AUTH_LOG_FILE" "")
+async_write = $(get_cfg_value "MUMBLE_AUTH_LOG_ASYNC_WRITE" "False")
+queue_size = $(get_cfg_value "MUMBLE_AUTH_LOG_QUEUE_SIZE" "10000")
+rate_limit = $(get_cfg_value "MUMBLE_AUTH_LOG_RATE_LIMIT" "0")
+rate_window = $(get_cfg_value "MUMBLE_AUTH_LOG_RATE_WINDOW" "10")
+
+[admission]
+enabled = $(get_cfg_value "MUMBLE_AUTH_ADMISSION_ENABLED" "False")
+reserve = $(get_cfg_value "MUMBLE_AUTH_ADMISSION_RESERVE" "2")
+auth = $(get_cfg_value "MUMBLE_AUTH_ADMISSION_AUTH" "0")
+lookup = $(get_cfg_value "MUMBLE_AUTH_ADMISSION_LOOKUP" "3")
+callback = $(get_cfg_value "MUMBLE_AUTH_ADMISSION_CALLBACK" "2")
+list = $(get_cfg_value "MUMBLE_AUTH_ADMISSION_LIST" "1")
+texture = $(get_cfg_value "MUMBLE_AUTH_ADMISSION_TEXTURE" "1")
+
+[pool]
+enabled = $(get_cfg_value "MUMBLE_AUTH_POOL_ENABLED" "False")
+interval = $(get_cfg_value "MUMBLE_AUTH_POOL_INTERVAL" "10")
+threads_min = $(get_cfg_value "MUMBLE_AUTH_POOL_THREADS_MIN" "5")
+threads_max = $(get_cfg_value "MUMBLE_AUTH_POOL_THREADS_MAX" "20")
+db_min = $(get_cfg_value "MUMBLE_AUTH_POOL_DB_MIN" "2")
+db_max = $(get_cfg_value "MUMBLE_AUTH_POOL_DB_MAX" "10")
+db_wait = $(get_cfg_value "MUMBLE_AUTH_POOL_DB_WAIT" "2.0")
+target_latency = $(get_cfg_value "MUMBLE_AUTH_POOL_TARGET_LATENCY" "100")
+idle_timeout = $(get_cfg_value "MUMBLE_AUTH_POOL_IDLE_TIMEOUT" "300")
+
+[trace]
+enabled = $(get_cfg_value "MUMBLE_AUTH_TRACE_ENABLED" "False")
+slow_threshold = $(get_cfg_value "MUMBLE_AUTH_TRACE_SLOW_THRESHOLD" "500")
+file = $(get_cfg_value "MUMBLE_AUTH_TRACE_FILE" "")
+
+[admin]
+enabled = $(get_cfg_value "MUMBLE_AUTH_ADMIN_ENABLED" "False")
+socket = $(get_cfg_value "MUMBLE_AUTH_ADMIN_SOCKET" "/tmp/authenticator.sock")
+profile_dir = $(get_cfg_value "MUMBLE_AUTH_ADMIN_PROFILE_DIR" "/tmp")
 
 [iceraw]
 Ice.ThreadPool.Server.Size = 5
@@ -87,6 +162,13 @@ channel = $(get_cfg_value "MUMBLE_AUTH_IDLE_CHANNEL" "1")
 denylist = $(get_cfg_value "MUMBLE_AUTH_IDLE_DENYLIST" "[]")
 allowlist = $(get_cfg_value "MUMBLE_AUTH_IDLE_ALLOWLIST" "[]")
 
+[health]
+enabled = $(get_cfg_value "MUMBLE_AUTH_HEALTH_ENABLED" "False")
+host = $(get_cfg_value "MUMBLE_AUTH_HEALTH_HOST" "127.0.0.1")
+port = $(get_cfg_value "MUMBLE_AUTH_HEALTH_PORT" "8081")
+interval = $(get_cfg_value "MUMBLE_AUTH_HEALTH_INTERVAL" "15")
+timeout = $(get_cfg_value "MUMBLE_AUTH_HEALTH_TIMEOUT" "5")
+
 [healthcheck]
 username = $(get_cfg_value "MUMBLE_AUTH_HEALTH_USERNAME" "healthcheck")
 password = $(get_cfg_value "MUMBLE_AUTH_HEALTH_PASSWORD" "")
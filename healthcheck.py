@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import logging
 import sys
+import time
 
 # Defaults
 config_file = "authenticator.ini"
@@ -102,11 +104,26 @@ parser.add_argument(
     help="ICE slice path",
 )
 
+parser.add_argument(
+    "-t",
+    "--timeout",
+    type=float,
+    default=10.0,
+    help="Overall deadline in seconds for checking all virtual servers",
+)
+
+parser.add_argument(
+    "-j",
+    "--json",
+    action="store_true",
+    help="Print a JSON report with per server status and latency",
+)
+
 args = parser.parse_args()
 
 # Import deps that require ICE after argument parsing so --help can be used without installing zeroc-ice.
 import Ice
-from authenticator import config as AuthConfig
+from authenticator import config as AuthConfig, load_slice
 
 if args.config is not None:
     logger.debug(f"Using custom config file {args.config}")
@@ -162,20 +179,8 @@ logger.debug(
 )
 
 # ICE Initialization
-slicedir = Ice.getSliceDir()
-
 logger.debug(f"Loading slice: {config.ice.slice}")
-Ice.loadSlice(config.ice.slice, ["-I" + slicedir])
-
-# ICE Slice module was changed from Murmur to MumbleServer in 1.5
-try:
-    import Murmur
-
-    logger.debug("Using pre-1.5 slice.")
-except ImportError:
-    import MumbleServer as Murmur
-
-    logger.debug("Using post-1.5 slice.")
+Murmur = load_slice(config.ice.slice)
 
 ice_init_data = Ice.InitializationData()
 ice_init_data.properties = Ice.createProperties(sys.argv)
@@ -195,54 +200,107 @@ with Ice.initialize(ice_init_data) as ice:
     meta = Murmur.MetaPrx.uncheckedCast(base)
 
     failure = False
+    report = {"host": f"{config.ice.host}:{config.ice.port}", "servers": {}}
+
+    def fatal(message):
+        logger.fatal(f"{config.ice.host}:{config.ice.port} - {message}")
+        if args.json:
+            report["status"] = "failure"
+            report["error"] = message
+            print(json.dumps(report))
+        exit(1)
+
+    start = time.perf_counter()
+    deadline = time.monotonic() + args.timeout
+
+    def remaining():
+        return max(0, deadline - time.monotonic())
+
+    def elapsed_ms(since):
+        return round((time.perf_counter() - since) * 1000, 1)
 
     try:
         servers = meta.getBootedServers()
         logger.info("ICE Connection successful.")
     except Murmur.InvalidSecretException:
-        logger.fatal(
-            f"{config.ice.host}:{config.ice.port} - ICE returned Invalid ICE Secret error"
-        )
-        exit(1)
+        fatal("ICE returned Invalid ICE Secret error")
     except Ice.TimeoutException:
-        logger.fatal(
-            f"{config.ice.host}:{config.ice.port} - ICE connection or operation timed out"
-        )
-        exit(1)
+        fatal("ICE connection or operation timed out")
     except Ice.ConnectionRefusedException:
-        logger.fatal(f"{config.ice.host}:{config.ice.port} - ICE connection refused")
-        exit(1)
+        fatal("ICE connection refused")
     except Ice.DNSException as e:
-        logger.fatal(f"{config.ice.host}:{config.ice.port} - Invalid ICE hostname")
-        exit(1)
+        fatal("Invalid ICE hostname")
 
+    report["ice_latency_ms"] = elapsed_ms(start)
     logger.info(f"Checking health on {len(servers)} virtual servers.")
-    logger.debug(f"Virtual Server ID(s): {', '.join([str(s.id()) for s in servers])}")
 
-    for server in servers:
-        if not config.murmur.servers or server.id() in config.murmur.servers:
-            try:
-                ret = server.verifyPassword(
-                    config.healthcheck.username, config.healthcheck.password
-                )
-            except Ice.TimeoutException:
-                logger.error(
-                    f"Verify Password call to virtual server {server.id()} timed out"
+    # Resolve all server ids at once, then run all password checks at once so a
+    # single hung virtual server does not delay the others
+    id_calls = [(server, server.idAsync()) for server in servers]
+    checks = []
+    for server, future in id_calls:
+        try:
+            server_id = future.result(remaining())
+        except Ice.Exception as e:
+            logger.error(f"Could not get the id of a virtual server: {e}")
+            failure = True
+            continue
+
+        if not config.murmur.servers or server_id in config.murmur.servers:
+            call_start = time.perf_counter()
+            latency = {}
+            future = server.verifyPasswordAsync(
+                config.healthcheck.username, config.healthcheck.password
+            )
+            future.add_done_callback(
+                lambda f, since=call_start, latency=latency: latency.setdefault(
+                    "ms", elapsed_ms(since)
                 )
-                ret = -2
-
-            logger.debug(f"Server: {server.id()} Ret: {ret}")
-            if config.healthcheck.password:
-                if ret == -1:
-                    logger.debug(f"Virtual server {server.id()}: Password failure")
-                    failure = True
-            if ret == -2:
-                logger.debug(f"Virtual server {server.id()}: Username failure")
+            )
+            checks.append((server_id, call_start, future, latency))
+
+    logger.debug(f"Virtual Server ID(s): {', '.join([str(c[0]) for c in checks])}")
+
+    for server_id, call_start, future, latency in checks:
+        status = "ok"
+        try:
+            ret = future.result(remaining())
+        except Ice.TimeoutException:
+            logger.error(f"Verify Password call to virtual server {server_id} timed out")
+            ret = -2
+            status = "timeout"
+        except Ice.Exception as e:
+            logger.error(f"Verify Password call to virtual server {server_id} failed: {e}")
+            ret = -2
+            status = "error"
+
+        logger.debug(f"Server: {server_id} Ret: {ret}")
+        if config.healthcheck.password:
+            if ret == -1:
+                logger.debug(f"Virtual server {server_id}: Password failure")
+                status = "password failure"
                 failure = True
+        if ret == -2:
+            logger.debug(f"Virtual server {server_id}: Username failure")
+            if status == "ok":
+                status = "username failure"
+            failure = True
+
+        report["servers"][str(server_id)] = {
+            "status": status,
+            "ret": ret,
+            "latency_ms": latency.get("ms", elapsed_ms(call_start)),
+        }
+
+    report["status"] = "failure" if failure else "success"
+    report["latency_ms"] = elapsed_ms(start)
 
     if failure:
         logger.info("Healthcheck failure.")
     else:
         logger.info("Healthcheck success.")
 
+    if args.json:
+        print(json.dumps(report))
+
     exit(failure)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Minimal probe for the authenticator's built-in health endpoint.
+
+Only uses the standard library so probes stay cheap, exits 0 when the
+authenticator reports itself healthy and 1 otherwise.
+"""
+
+import argparse
+import configparser
+import json
+import sys
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+parser = argparse.ArgumentParser(
+    prog="Healthprobe",
+    description="Mumble auth health endpoint probe",
+)
+parser.add_argument(
+    "-c",
+    "--config",
+    type=str,
+    default="authenticator.ini",
+    help="Config file to read the health endpoint from",
+)
+parser.add_argument(
+    "-u",
+    "--url",
+    type=str,
+    help="Health endpoint URL, overrides the config file",
+)
+parser.add_argument(
+    "-t",
+    "--timeout",
+    type=float,
+    default=5.0,
+    help="Request timeout in seconds",
+)
+parser.add_argument(
+    "-v",
+    "--verbose",
+    action="store_true",
+    help="Print the health report",
+)
+
+args = parser.parse_args()
+
+url = args.url
+if url is None:
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    host = config.get("health", "host", fallback="127.0.0.1")
+    port = config.getint("health", "port", fallback=8081)
+    url = f"http://{host}:{port}/health"
+
+try:
+    with urlopen(url, timeout=args.timeout) as response:
+        body = response.read()
+except HTTPError as e:
+    # Unhealthy reports are served with a 503 but still carry the report
+    body = e.read()
+except OSError as e:
+    print(f"Health endpoint {url} unreachable: {e}", file=sys.stderr)
+    sys.exit(1)
+
+try:
+    report = json.loads(body)
+except ValueError:
+    print(f"Health endpoint {url} returned an invalid report", file=sys.stderr)
+    sys.exit(1)
+
+if args.verbose:
+    print(json.dumps(report, indent=2))
+
+sys.exit(0 if report.get("status") == "ok" else 1)